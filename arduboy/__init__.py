@@ -0,0 +1,21 @@
+# Library interface of the Arduboy python utilities. The functions return their results
+# and raise exceptions derived from ArduboyError instead of exiting, so many operations
+# can be run from one process. The scripts are thin commandline wrappers around them.
+
+from arduboy.aiobootloader import AsyncBootLoader, BootLoaderError, FlashCartError
+from arduboy.buildcache import AssetStore
+from arduboy.builder import BuildError, BuildResult, Slot, build_flashcart, build_stream
+from arduboy.common import BootLoader, DeviceNotFoundError
+from arduboy.device import FlashCart, connect, open_flashcart
+from arduboy.eeprom import backup_eeprom, erase_eeprom, restore_eeprom
+from arduboy.errors import ArduboyError, VerifyError
+from arduboy.flashcart import BackupError, BackupResult, WriteResult, backup_flashcart, development_layout, \
+    image_blocks, program_blocks, write_flashcart, write_flashcart_file, write_flashcart_stream, write_sparse_image
+from arduboy.hexfile import HexFileError
+from arduboy.image import convert_image
+from arduboy.metrics import Metrics, metrics
+from arduboy.sketch import Sketch, backup_sketch, erase_sketch, load_sketch, upload_sketch
+from arduboy.slots import CartImage, ImageFile, SlotContents, SlotError, SlotInfo, load_slot_table, read_slot, \
+    replace_slot, scan_slots
+from arduboy.sparseimage import SparseImageError
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_FULL, VERIFY_MODES, VERIFY_NONE, VERIFY_SAMPLE
@@ -0,0 +1,389 @@
+# Asyncio client for the Arduboy (Caterina / Cathy) bootloader protocol.
+# Many devices can share one event loop. On POSIX the serial port file descriptor
+# is watched by the event loop, elsewhere the port is polled for received data.
+#
+# Every command has a timeout. A command that times out or is cancelled leaves the
+# bootloader in an unknown state, after which the client refuses further commands
+# and should be closed.
+#
+# Checksum command extension: 'h' is acknowledged with '\r' by bootloaders that support
+# it (others answer '?'), followed by the length high and low bytes and memory type like
+# 'g'. The reply is the big endian CRC32 of length bytes from the current address, which
+# is advanced like 'g' does.
+
+import asyncio
+import os
+from collections import deque
+
+from arduboy.errors import ArduboyError
+from arduboy.metrics import metrics
+
+ACK = b"\r"
+DEFAULT_WINDOW = 8
+COMMAND_TIMEOUT = 10
+POLL_INTERVAL_MIN = 0.001
+POLL_INTERVAL_MAX = 0.01
+MAX_BLOCK_LENGTH = 65536  # block commands have a 16 bit length, 0 is used for 64K
+
+
+class BootLoaderError(ArduboyError):
+    pass
+
+
+class FlashCartError(BootLoaderError):
+    # no flash cart support or no flash cart detected
+    pass
+
+
+class AsyncBootLoader:
+    def __init__(self, serial, timeout=COMMAND_TIMEOUT):
+        # serial is an open pyserial port (or an object with the same read, write,
+        # in_waiting and close members)
+        self.serial = serial
+        self.timeout = timeout
+        self._buffer = bytearray()
+        self._lock = None  # created in the event loop, see _attach
+        self._loop = None
+        self._fd = None
+        self._data_ready = None
+        self._failed = False
+        self._checksum_support = None
+        try:
+            self._fd = serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    ############################################################################
+    # transport
+
+    def _attach(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._loop is not None and self._fd is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._fd)
+        self._loop = loop
+        self._lock = asyncio.Lock()
+        self._data_ready = asyncio.Event()
+        if self._fd is not None:
+            try:
+                loop.add_reader(self._fd, self._on_readable)
+            except NotImplementedError:
+                self._fd = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            # device disconnected
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        self._buffer += data
+        self._data_ready.set()
+
+    async def _write(self, data):
+        self._attach()
+        with metrics.timer("serial.write", len(data)):
+            if self._fd is None:
+                self.serial.write(data)
+                return
+            view = memoryview(data)
+            while view:
+                try:
+                    view = view[os.write(self._fd, view):]
+                except BlockingIOError:
+                    writable = self._loop.create_future()
+                    self._loop.add_writer(self._fd, writable.set_result, None)
+                    try:
+                        await writable
+                    finally:
+                        self._loop.remove_writer(self._fd)
+
+    async def _fill(self, size):
+        # waits until at least size bytes are buffered
+        self._attach()
+        interval = POLL_INTERVAL_MIN
+        while len(self._buffer) < size:
+            if self._fd is not None:
+                self._data_ready.clear()
+                await self._data_ready.wait()
+                continue
+            waiting = self.serial.in_waiting
+            if waiting:
+                self._buffer += self.serial.read(waiting)
+                interval = POLL_INTERVAL_MIN
+            else:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    async def _read(self, size):
+        # the read time is the time spent waiting for the bootloader response
+        with metrics.timer("serial.read", size) as timer:
+            try:
+                if len(self._buffer) < size:
+                    await asyncio.wait_for(self._fill(size), self.timeout)
+            except asyncio.TimeoutError:
+                self._failed = True
+                timer.nbytes = 0
+                metrics.count("serial.timeouts")
+                raise BootLoaderError(f"Bootloader did not respond within {self.timeout} seconds")
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _expect_ack(self, command):
+        response = await self._read(1)
+        if response != ACK:
+            raise BootLoaderError(f"Bootloader did not acknowledge '{command}' command (got {response!r})")
+
+    @property
+    def failed(self):
+        # True after a command failed with responses left unread
+        return self._failed
+
+    def _check(self):
+        if self._failed:
+            raise BootLoaderError("Bootloader connection is out of sync after a failed command")
+
+    def _check_length(self, length, minimum=1):
+        if not minimum <= length <= MAX_BLOCK_LENGTH:
+            raise ValueError(f"Block length {length} is not between {minimum} and {MAX_BLOCK_LENGTH} bytes")
+
+    def _unread(self, pending):
+        # a pipelined command failed before all its responses were read
+        if pending:
+            self._failed = True
+
+    async def _command(self, command):
+        # runs one complete command exclusively
+        self._attach()
+        async with self._lock:
+            self._check()
+            try:
+                return await command()
+            except asyncio.CancelledError:
+                self._failed = True
+                raise
+
+    ############################################################################
+    # raw access for commands that have no method of their own
+
+    async def write(self, data):
+        self._check()
+        await self._write(data)
+        return len(data)
+
+    async def read(self, size):
+        self._check()
+        return await self._read(size)
+
+    ############################################################################
+    # commands
+
+    async def get_version(self):
+        async def command():
+            await self._write(b"V")
+            return int(await self._read(2))
+        return await self._command(command)
+
+    async def read_jedec_id(self):
+        # raises BootLoaderError when there is no flash cart
+        async def command():
+            await self._write(b"j")
+            jedec_id = await self._read(3)
+            await asyncio.sleep(0.5)
+            await self._write(b"j")
+            jedec_id2 = await self._read(3)
+            if jedec_id2 != jedec_id or jedec_id == b'\x00\x00\x00' or jedec_id == b'\xFF\xFF\xFF':
+                raise FlashCartError("No flash cart detected.")
+            return bytearray(jedec_id)
+        return await self._command(command)
+
+    async def set_address(self, address):
+        async def command():
+            await self._write(bytearray([ord("A"), address >> 8, address & 0xFF]))
+            await self._expect_ack("A")
+        await self._command(command)
+
+    async def set_led(self, control):
+        # control is the 'x' command byte: RGB LED bits and button / RX TX LED control
+        async def command():
+            await self._write(bytearray([ord("x"), control]))
+            await self._read(1)
+        await self._command(command)
+
+    async def exit(self):
+        async def command():
+            await self._write(b"E")
+            await self._read(1)
+        await self._command(command)
+
+    async def has_checksum(self):
+        # probes once whether the bootloader supports the checksum command
+        if self._checksum_support is None:
+            async def command():
+                await self._write(b"h")
+                if await self._read(1) != ACK:
+                    return False
+                # complete the command with a 1 byte EEPROM checksum
+                await self._write(bytearray([0, 1, ord("E")]))
+                await self._read(4)
+                return True
+            self._checksum_support = await self._command(command)
+        return self._checksum_support
+
+    async def checksums(self, blocks, memtype, window=DEFAULT_WINDOW):
+        # returns the CRC32 checksums of (address, length) blocks. Requires checksum
+        # support (see has_checksum). Up to window commands are sent ahead.
+        async def command():
+            results = []
+            pending = 0
+            try:
+                for address, length in blocks:
+                    try:
+                        self._check_length(length)
+                    except ValueError:
+                        while pending:
+                            await self._read_checksum()
+                            pending -= 1
+                        raise
+                    pending += 1
+                    await self._write(bytearray([ord("A"), address >> 8, address & 0xFF,
+                                                 ord("h"), (length >> 8) & 0xFF, length & 0xFF, ord(memtype)]))
+                    if pending > window:
+                        results.append(await self._read_checksum())
+                        pending -= 1
+                while pending:
+                    results.append(await self._read_checksum())
+                    pending -= 1
+            except Exception:
+                self._unread(pending)
+                raise
+            return results
+        return await self._command(command)
+
+    async def _read_checksum(self):
+        await self._expect_ack("A")
+        await self._expect_ack("h")
+        return int.from_bytes(await self._read(4), "big")
+
+    async def checksum(self, address, length, memtype):
+        return (await self.checksums([(address, length)], memtype))[0]
+
+    async def write_blocks(self, blocks, memtype, window=DEFAULT_WINDOW):
+        # Writes (address, data) blocks. Address and block write commands for up to
+        # window blocks are sent back to back before their acknowledgements are read.
+        async def command():
+            pending = 0
+            try:
+                for address, data in blocks:
+                    try:
+                        self._check_length(len(data), 0)
+                    except ValueError:
+                        while pending:
+                            await self._expect_ack("A")
+                            await self._expect_ack("B")
+                            pending -= 1
+                        raise
+                    pending += 1
+                    # a length of 0 is used for 64K blocks
+                    await self._write(bytearray([ord("A"), address >> 8, address & 0xFF,
+                                                 ord("B"), (len(data) >> 8) & 0xFF, len(data) & 0xFF, ord(memtype)]))
+                    await self._write(data)
+                    if pending > window:
+                        await self._expect_ack("A")
+                        await self._expect_ack("B")
+                        pending -= 1
+                while pending:
+                    await self._expect_ack("A")
+                    await self._expect_ack("B")
+                    pending -= 1
+            except Exception:
+                self._unread(pending)
+                raise
+        await self._command(command)
+
+    async def read_blocks(self, blocks, memtype, window=DEFAULT_WINDOW):
+        # Reads (address, length) blocks and yields their data in order. Up to window
+        # address and block read commands are queued ahead of the data being read.
+        self._attach()
+        async with self._lock:
+            self._check()
+            blocks = iter(blocks)
+            pending = deque()
+            try:
+                while True:
+                    while len(pending) < window:
+                        block = next(blocks, None)
+                        if block is None: break
+                        address, length = block
+                        try:
+                            self._check_length(length)
+                        except ValueError:
+                            await self._discard(pending)
+                            raise
+                        pending.append(length)
+                        await self._write(bytearray([ord("A"), address >> 8, address & 0xFF,
+                                                     ord("g"), (length >> 8) & 0xFF, length & 0xFF, ord(memtype)]))
+                    if not pending: break
+                    await self._expect_ack("A")
+                    length = pending.popleft()
+                    yield await self._read(length)
+            except GeneratorExit:
+                # reader stopped early, discard the responses to commands already sent
+                await self._discard(pending)
+                raise
+            except asyncio.CancelledError:
+                self._failed = True
+                raise
+            except Exception:
+                self._unread(len(pending))
+                raise
+
+    async def _discard(self, pending):
+        # reads and drops the responses to the pending block reads
+        while pending:
+            await self._read(1 + pending.popleft())
+
+    async def write_span(self, address, data, pagesize, memtype, window=DEFAULT_WINDOW):
+        # Writes data to consecutive pages using a single address command. The
+        # bootloader advances the address after each page sized block write.
+        async def command():
+            pending = 1
+            try:
+                await self._write(bytearray([ord("A"), address >> 8, address & 0xFF]))
+                for offset in range(0, len(data), pagesize):
+                    page = data[offset:offset + pagesize]
+                    pending += 1
+                    await self._write(bytearray([ord("B"), (len(page) >> 8) & 0xFF, len(page) & 0xFF, ord(memtype)]))
+                    await self._write(page)
+                    if pending > window:
+                        await self._expect_ack("B")
+                        pending -= 1
+                while pending:
+                    await self._expect_ack("B")
+                    pending -= 1
+            except Exception:
+                self._unread(pending)
+                raise
+        await self._command(command)
+
+    async def write_block(self, address, data, memtype):
+        await self.write_blocks([(address, data)], memtype)
+
+    async def read_block(self, address, length, memtype):
+        blocks = self.read_blocks([(address, length)], memtype)
+        try:
+            return await blocks.__anext__()
+        finally:
+            await blocks.aclose()
+
+    def close(self):
+        if self._fd is not None and self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._fd)
+        self._fd = None
+        self.serial.close()
@@ -0,0 +1,115 @@
+# Conversion of 1 bit images to the Arduboy display format: 8 pixel high
+# pages of column bytes with the topmost pixel in the least significant bit.
+# NumPy is used when it is installed. Pillow is imported when an image is created, so
+# packing alone does not need it.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# _spread[p][v] places the bits of row p of an 8 x 8 pixel block (the packed row
+# byte v, leftmost pixel in the most significant bit) into the 8 column bytes
+_spread = [[sum(1 << (k * 8 + p) for k in range(8) if v & (0x80 >> k)) for v in range(256)] for p in range(8)]
+
+
+def pack_pages_numpy(img):
+    width, height = img.size
+    pixels = numpy.asarray(img.convert("1"), dtype=bool)
+    pages = pixels.reshape(height // 8, 8, width).transpose(0, 2, 1)
+    return bytearray(numpy.packbits(pages, axis=-1, bitorder="little").tobytes())
+
+
+def pack_pages_python(img):
+    img = img.convert("1")
+    width, height = img.size
+    rowbytes = (width + 7) // 8
+    rows = img.tobytes()
+    buffer = bytearray()
+    for y in range(0, height, 8):
+        page = [rows[(y + p) * rowbytes:(y + p + 1) * rowbytes] for p in range(8)]
+        for c in range(rowbytes):
+            block = (_spread[0][page[0][c]] | _spread[1][page[1][c]] | _spread[2][page[2][c]] |
+                     _spread[3][page[3][c]] | _spread[4][page[4][c]] | _spread[5][page[5][c]] |
+                     _spread[6][page[6][c]] | _spread[7][page[7][c]])
+            buffer += block.to_bytes(8, "little")[:width - c * 8]
+    return buffer
+
+
+def pack_pages(img):
+    # returns the display data of a 1 bit image whose height is a multiple of 8
+    if numpy is not None:
+        return pack_pages_numpy(img)
+    return pack_pages_python(img)
+
+
+def unpack_pages(data, width, height):
+    # returns the 1 bit image of display data, the inverse of pack_pages
+    from PIL import Image
+    img = Image.new("1", (width, height))
+    pixels = img.load()
+    for i, value in enumerate(data[:width * height // 8]):
+        x = i % width
+        y = i // width * 8
+        for p in range(8):
+            if value >> p & 1:
+                pixels[x, y + p] = 255
+    return img
+
+
+def has_transparency(img):
+    return img.convert("RGBA").getchannel("A").getextrema()[0] < 255
+
+
+def encode_sprites_numpy(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency):
+    rgba = numpy.asarray(img.convert("RGBA"))
+    ys = spacing + numpy.arange(vframes)[:, None] * (sprite_height + spacing) + numpy.arange(sprite_height)
+    xs = spacing + numpy.arange(hframes)[:, None] * (sprite_width + spacing) + numpy.arange(sprite_width)
+    frames = rgba[ys[:, None, :, None], xs[None, :, None, :]]  # vframes, hframes, height, width, RGBA
+    pages = (sprite_height + 7) // 8
+    planes = [frames[..., 1] > 64]  # white pixels
+    if transparency:
+        planes.append(frames[..., 3] == 255)  # opaque pixels
+    packed = []
+    for plane in planes:
+        # pad height to a multiple of 8 pixels and pack each 8 pixel column into a byte
+        plane = numpy.pad(plane, ((0, 0), (0, 0), (0, pages * 8 - sprite_height), (0, 0)))
+        plane = plane.reshape(vframes, hframes, pages, 8, sprite_width).transpose(0, 1, 2, 4, 3)
+        packed.append(numpy.packbits(plane, axis=-1, bitorder="little")[..., 0])
+    # sprite and mask bytes are interleaved
+    return bytearray(numpy.stack(packed, axis=-1).tobytes())
+
+
+def encode_sprites_python(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency):
+    from PIL import Image
+    img = img.convert("RGBA")
+    planes = [img.getchannel("G").point([255 if v > 64 else 0 for v in range(256)], "1")]
+    if transparency:
+        planes.append(img.getchannel("A").point([255 if v == 255 else 0 for v in range(256)], "1"))
+    pages = (sprite_height + 7) // 8
+    buffer = bytearray()
+    for v in range(vframes):
+        fy = spacing + v * (sprite_height + spacing)
+        for h in range(hframes):
+            fx = spacing + h * (sprite_width + spacing)
+            packed = []
+            for plane in planes:
+                frame = Image.new("1", (sprite_width, pages * 8), 0)
+                frame.paste(plane.crop((fx, fy, fx + sprite_width, fy + sprite_height)), (0, 0))
+                packed.append(pack_pages_python(frame))
+            if transparency:
+                data = bytearray(len(packed[0]) * 2)
+                data[0::2] = packed[0]
+                data[1::2] = packed[1]
+                buffer += data
+            else:
+                buffer += packed[0]
+    return buffer
+
+
+def encode_sprites(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency):
+    # returns the frames of a sprite sheet in frame, page, column order with the mask
+    # byte following each sprite byte when transparency is used
+    if numpy is not None:
+        return encode_sprites_numpy(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency)
+    return encode_sprites_python(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency)
@@ -0,0 +1,108 @@
+# Content addressed on-disk cache for decoded flash cart build assets.
+# Entries are keyed by a hash of the source file contents and the kind of
+# conversion applied. The least recently used entries are evicted when the
+# cache grows beyond its maximum size. The AssetStore keeps decoded assets in
+# memory, so images built in one run share them.
+
+import hashlib
+import os
+
+CACHE_VERSION = b"1"
+DEFAULT_CACHE_DIR = ".flashcart-cache"
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildCache:
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_filename(self, kind, digest):
+        key = hashlib.sha256(CACHE_VERSION + kind.encode() + digest.encode()).hexdigest()
+        return os.path.join(self.directory, f"{kind}-{key}.bin")
+
+    def get(self, kind, source_filename, loader, digest=None):
+        # returns loader(source_filename), decoding only when the contents are not cached yet.
+        # digest is the file_digest of the source file when already known.
+        if not os.path.isfile(source_filename):
+            return loader(source_filename)
+        entry = self._entry_filename(kind, digest or file_digest(source_filename))
+        try:
+            with open(entry, "rb") as f:
+                data = bytearray(f.read())
+            os.utime(entry)  # mark as most recently used
+            self.hits += 1
+            return data
+        except OSError:
+            pass
+        data = loader(source_filename)
+        self.misses += 1
+        tempname = f"{entry}.{os.getpid()}.tmp"
+        with open(tempname, "wb") as f:
+            f.write(data)
+        os.replace(tempname, entry)
+        return data
+
+    def evict(self):
+        # remove least recently used entries until the cache fits in max_size
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"): continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        entries.sort()
+        for _, size, filename in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+
+class AssetStore:
+    # decoded assets shared by the flash cart images built in one run. Assets are keyed by
+    # kind and source file digest, so files with the same contents are decoded once and
+    # all images refer to the same buffer. Stored assets must not be modified.
+    def __init__(self):
+        self.assets = {}
+        self.loaded = 0  # unique assets decoded or read from the build cache
+        self.shared = 0  # asset references served from the store
+        self._digests = {}
+
+    def digest(self, filename):
+        # returns the file_digest of a source file (hashed once) or None when it does not exist
+        if filename not in self._digests:
+            self._digests[filename] = file_digest(filename) if os.path.isfile(filename) else None
+        return self._digests[filename]
+
+    def key(self, kind, filename):
+        # missing files are keyed by name, so their loader reports the right file
+        return kind, self.digest(filename) or filename
+
+    def __contains__(self, key):
+        return key in self.assets
+
+    def add(self, key, data):
+        self.assets[key] = bytes(data)
+        self.loaded += 1
+
+    def get(self, key):
+        return self.assets[key]
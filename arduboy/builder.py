@@ -0,0 +1,290 @@
+# Building flash cart images from an index file (.csv) with title screens, hex files and
+# data files.
+
+import csv
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from arduboy.bitmap import pack_pages
+from arduboy.buildcache import BuildCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+from arduboy.errors import ArduboyError
+from arduboy.hexfile import HexFileError, load_hex_file, used_length
+from arduboy.manifest import BlockHasher, manifest_filename, save_manifest
+
+ID_LIST = 0
+ID_TITLE = 1
+ID_TITLESCREEN = 2
+ID_HEXFILE = 3
+ID_DATAFILE = 4
+ID_SAVEFILE = 5
+
+Slot = namedtuple("Slot", "list title currentpage previouspage nextpage programsize datasize")
+BuildResult = namedtuple("BuildResult", "filename title_screens sketches pages cache_hits cache_misses")
+
+asset_cache = None  # the build cache of a worker process, see init_worker
+
+
+class BuildError(ArduboyError):
+    pass
+
+
+def default_header():
+    return bytearray("ARDUBOY".encode() + (b'\xFF' * 249))
+
+
+def slot_header(listnumber, currentpage, previouspage, nextpage, program, datasize):
+    # returns the header of a slot. The program and data follow the header and title screen
+    # pages, the data page is patched into the program.
+    header = default_header()
+    programsize = len(program)
+    slotsize = nextpage - currentpage
+    programpage = currentpage + 5
+    datapage = programpage + (programsize >> 8)
+    header[7] = listnumber  # list number
+    header[8] = previouspage >> 8
+    header[9] = previouspage & 0xFF
+    header[10] = nextpage >> 8
+    header[11] = nextpage & 0xFF
+    header[12] = slotsize >> 8
+    header[13] = slotsize & 0xFF
+    header[14] = programsize >> 7  # program size in 128 byte pages
+    if programsize > 0:
+        header[15] = programpage >> 8
+        header[16] = programpage & 0xFF
+        if datasize > 0:
+            program[0x14] = 0x18
+            program[0x15] = 0x95
+            program[0x16] = datapage >> 8
+            program[0x17] = datapage & 0xFF
+    if datasize > 0:
+        header[17] = datapage >> 8
+        header[18] = datapage & 0xFF
+    return header
+
+
+def load_title_screen_data(screen_filename):
+    if not os.path.isfile(screen_filename):
+        raise BuildError(f"Title screen '{screen_filename}' not found.")
+    from PIL import Image  # only needed for building, not by the other tools
+    img = Image.open(screen_filename).convert("1")
+    width, height = img.size
+    if (width != 128) or (height != 64):
+        raise BuildError(f"Title screen '{screen_filename}' is not 128 x 64 pixels.")
+    return pack_pages(img)
+
+
+def load_hex_file_data(hex_filename):
+    if not os.path.isfile(hex_filename):
+        return bytearray()
+    try:
+        buffer, page_used = load_hex_file(hex_filename)
+    except HexFileError:
+        raise BuildError(f"Hex file '{hex_filename}' contains errors.")
+    flash_end = (used_length(page_used) + 255) // 256 * 256
+    return buffer[0:flash_end]
+
+
+def load_data_file(data_filename):
+    if not os.path.isfile(data_filename):
+        return bytearray()
+
+    with open(data_filename, "rb") as file_handle:
+        buffer = bytearray(file_handle.read())
+        pagealign = bytearray(b'\xFF' * (256 - len(buffer) % 256))
+        return buffer + pagealign
+
+
+def resolve_filename(filename, basepath):
+    # filenames in an index file are relative to the directory of the index file
+    if not os.path.isabs(filename):
+        return basepath + filename
+    return filename
+
+
+def init_worker(cachedir, cachesize):
+    global asset_cache
+    asset_cache = BuildCache(cachedir, cachesize) if cachedir else None
+
+
+def load_slot_assets(titlefile, hexfile, datafilename, cache=None):
+    # returns the decoded title screen, program and data of a slot and the cache hits and misses.
+    # Worker processes use the cache of init_worker.
+    cache = cache or asset_cache
+    if cache:
+        hits, misses = cache.hits, cache.misses
+        title = cache.get("title", titlefile, load_title_screen_data)
+        program = cache.get("program", hexfile, load_hex_file_data)
+        datafile = cache.get("data", datafilename, load_data_file)
+        return title, program, datafile, cache.hits - hits, cache.misses - misses
+    return load_title_screen_data(titlefile), load_hex_file_data(hexfile), load_data_file(datafilename), 0, 0
+
+
+ASSET_LOADERS = {"title": load_title_screen_data, "program": load_hex_file_data, "data": load_data_file}
+
+
+def load_asset(kind, filename, digest, cache=None):
+    # returns a decoded asset and the cache hits and misses
+    cache = cache or asset_cache
+    if cache:
+        hits, misses = cache.hits, cache.misses
+        data = cache.get(kind, filename, ASSET_LOADERS[kind], digest)
+        return data, cache.hits - hits, cache.misses - misses
+    return ASSET_LOADERS[kind](filename), 0, 0
+
+
+def store_slots(store, titlefiles, hexfiles, datafiles, cachedir, cachesize, jobs):
+    # decodes the assets of the slots missing from store, each unique asset once, and
+    # returns the slot contents referring to the stored assets like load_slot_assets does.
+    # The cache hits and misses are reported with the first slot.
+    slotkeys = [(store.key("title", titlefile), store.key("program", hexfile), store.key("data", datafile))
+                for titlefile, hexfile, datafile in zip(titlefiles, hexfiles, datafiles)]
+    missing = {}
+    for keys, filenames in zip(slotkeys, zip(titlefiles, hexfiles, datafiles)):
+        for key, filename in zip(keys, filenames):
+            if key in store or key in missing:
+                store.shared += 1
+            else:
+                missing[key] = filename
+    kinds = [key[0] for key in missing]
+    filenames = list(missing.values())
+    digests = [store.digest(filename) for filename in filenames]
+    hits = misses = 0
+    if jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(cachedir, cachesize)) as executor:
+            assets = list(executor.map(load_asset, kinds, filenames, digests))
+    else:
+        cache = BuildCache(cachedir, cachesize) if cachedir else None
+        assets = (load_asset(kind, filename, digest, cache)
+                  for kind, filename, digest in zip(kinds, filenames, digests))
+    for key, (data, assethits, assetmisses) in zip(missing, assets):
+        store.add(key, data)
+        hits += assethits
+        misses += assetmisses
+    for title, program, datafile in slotkeys:
+        yield store.get(title), bytearray(store.get(program)), store.get(datafile), hits, misses
+        hits = misses = 0
+
+
+def image_filename(csvfile):
+    # flashcart-index.csv is built to flashcart-image.bin
+    return csvfile.lower().replace("-index", "").replace(".csv", "-image.bin")
+
+
+def bounded_map(executor, function, *iterables, window):
+    # like executor.map but submits at most window calls ahead of the results taken. Calls
+    # that did not start yet are cancelled when the generator is closed early.
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(executor.submit(function, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def build_stream(csvfile, cache=True, cachedir=None, cachesize=DEFAULT_MAX_SIZE, jobs=1, progress=None,
+                 store=None):
+    # returns a generator of the flash cart image of an index file as page aligned chunks:
+    # the header, title screen, program and data of each slot in turn. Only a few slots are
+    # decoded ahead, so memory use does not depend on the image size. The generator returns
+    # a BuildResult without filename when exhausted. See build_flashcart for the options.
+    csvfile = os.path.abspath(csvfile)
+    path = os.path.dirname(csvfile) + os.sep
+    if not os.path.isfile(csvfile):
+        raise BuildError(f"CSV-file '{csvfile}' not found.")
+    if not cache:
+        cachedir = None
+    elif cachedir is None:
+        cachedir = path + DEFAULT_CACHE_DIR
+    with open(csvfile, "r") as file:
+        data = csv.reader(file, quotechar='"', delimiter=";")
+        next(data, None)
+        rows = []
+        for row in data:
+            while len(row) < 7: row.append('')  # add missing cells
+            rows.append(row)
+    # resolved now, the image is generated later
+    titlefiles = [resolve_filename(row[ID_TITLESCREEN], path) for row in rows]
+    hexfiles = [resolve_filename(row[ID_HEXFILE], path) for row in rows]
+    datafiles = [resolve_filename(row[ID_DATAFILE], path) for row in rows]
+    return generate_image(rows, titlefiles, hexfiles, datafiles, cachedir, cachesize, jobs, progress, store)
+
+
+def generate_image(rows, titlefiles, hexfiles, datafiles, cachedir, cachesize, jobs, progress, store=None):
+    previouspage = 0xFFFF
+    currentpage = 0
+    nextpage = 0
+    title_screens = 0
+    sketches = 0
+    cache_hits = 0
+    cache_misses = 0
+    # slot contents are decoded in parallel, headers are chained and written in index order
+    if store is not None:
+        executor = None
+        slots = store_slots(store, titlefiles, hexfiles, datafiles, cachedir, cachesize, jobs)
+    elif jobs > 1:
+        executor = ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(cachedir, cachesize))
+        slots = bounded_map(executor, load_slot_assets, titlefiles, hexfiles, datafiles, window=2 * jobs)
+    else:
+        executor = None
+        cache = BuildCache(cachedir, cachesize) if cachedir else None
+        slots = (load_slot_assets(titlefile, hexfile, datafile, cache)
+                 for titlefile, hexfile, datafile in zip(titlefiles, hexfiles, datafiles))
+    try:
+        for row, (title, program, datafile, hits, misses) in zip(rows, slots):
+            cache_hits += hits
+            cache_misses += misses
+            programsize = len(program)
+            datasize = len(datafile)
+            nextpage += ((programsize + datasize) >> 8) + 5
+            header = slot_header(int(row[ID_LIST]), currentpage, previouspage, nextpage, program, datasize)
+            yield header
+            yield title
+            if programsize > 0:
+                yield program
+            if datasize > 0:
+                yield datafile
+            if progress:
+                progress(Slot(row[ID_LIST], row[ID_TITLE], currentpage, previouspage, nextpage, programsize,
+                              datasize))
+            previouspage = currentpage
+            currentpage = nextpage
+            if programsize > 0:
+                sketches += 1
+            else:
+                title_screens += 1
+    finally:
+        if executor:
+            slots.close()
+            executor.shutdown()
+    if cachedir:
+        BuildCache(cachedir, cachesize).evict()
+    return BuildResult(None, title_screens, sketches, nextpage, cache_hits, cache_misses)
+
+
+def build_flashcart(csvfile, filename=None, cache=True, cachedir=None, cachesize=DEFAULT_MAX_SIZE, jobs=1,
+                    progress=None, store=None):
+    # builds the flash cart image of an index file and returns a BuildResult. Decoded assets
+    # are kept in a build cache, by default in a directory next to the index file. Slot
+    # assets are decoded by jobs processes. progress(slot) is called with the Slot of each row.
+    # Images built with the same buildcache.AssetStore decode each unique asset only once.
+    if filename is None:
+        filename = image_filename(os.path.abspath(csvfile))
+    stream = build_stream(csvfile, cache, cachedir, cachesize, jobs, progress, store)
+    hasher = BlockHasher()
+    with open(filename, "wb") as binfile:
+        while True:
+            try:
+                chunk = next(stream)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            binfile.write(chunk)
+            hasher.update(chunk)
+    save_manifest(manifest_filename(filename), hasher.finish(), hasher.size)
+    return result._replace(filename=filename)
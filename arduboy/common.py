@@ -0,0 +1,246 @@
+import asyncio
+import os
+import sys
+import time
+
+from serial import Serial
+
+from arduboy.aiobootloader import DEFAULT_WINDOW, AsyncBootLoader, BootLoaderError, FlashCartError
+from arduboy.discovery import DeviceWatcher, find_devices, vidpid_table, wait_for_device
+from arduboy.metrics import metrics
+
+compatibledevices = [
+    # Arduboy Leonardo
+    "VID:PID=2341:0036", "VID:PID=2341:8036",
+    "VID:PID=2A03:0036", "VID:PID=2A03:8036",
+    # Arduboy Micro
+    "VID:PID=2341:0037", "VID:PID=2341:8037",
+    "VID:PID=2A03:0037", "VID:PID=2A03:8037",
+    # Genuino Micro
+    "VID:PID=2341:0237", "VID:PID=2341:8237",
+    # Sparkfun Pro Micro 5V
+    "VID:PID=1B4F:9205", "VID:PID=1B4F:9206",
+    # Adafruit ItsyBitsy 5V
+    "VID:PID=239A:000E", "VID:PID=239A:800E",
+]
+
+compatible_vidpids = vidpid_table(compatibledevices)
+
+BOOTLOADER_TIMEOUT = 10
+OPEN_TIMEOUT = 10
+# a port in bootloader mode to use without device discovery, like an emulator (see emulator.py)
+PORT_ENVIRONMENT = "ARDUBOY_PORT"
+
+manufacturers = {
+    0x01: "Spansion",
+    0x14: "Cypress",
+    0x1C: "EON",
+    0x1F: "Adesto(Atmel)",
+    0x20: "Micron",
+    0x37: "AMIC",
+    0x9D: "ISSI",
+    0xC2: "General Plus",
+    0xC8: "Giga Device",
+    0xBF: "Microchip",
+    0xEF: "Winbond"
+}
+
+
+class DeviceNotFoundError(BootLoaderError):
+    pass
+
+
+class BootLoader:
+    # synchronous wrapper around AsyncBootLoader running its own event loop
+    def __init__(self, port=None, verbose=True):
+        # when port is None the first compatible device found is used
+        self._client = None
+        self._loop = None  # created by the first synchronous call
+        self._active = False
+        self._port = port
+        self._location = None
+        self.verbose = verbose
+
+    def _print(self, message, end="\n"):
+        if self.verbose:
+            sys.stdout.write(message + end)
+            sys.stdout.flush()
+
+    def start(self):
+        # find and connect to Arduboy in bootloader mode
+        try:
+            self.connect()
+        except BootLoaderError as e:
+            print(e)
+            delayed_exit()
+
+    def connect(self):
+        # like start() but raises BootLoaderError instead of exiting
+        port = os.environ.get(PORT_ENVIRONMENT) if self._port is None else None
+        if port:
+            self._active = True
+            self._print(f"Using bootloader at port {port}")
+        else:
+            with metrics.timer("connect.discovery"):
+                device = self._find_device(find_devices(compatible_vidpids))
+            if device is None:
+                raise DeviceNotFoundError("Arduboy not found.")
+            port = device.port
+            self._active = device.bootloader
+            self._location = device.location
+            self._print(f"Found {device.description} at port {port}")
+        if not self._active:
+            self._print("Selecting bootloader mode...")
+            with metrics.timer("connect.bootloader_reset"), DeviceWatcher() as watcher:
+                bootloader = Serial(port, 1200)
+                bootloader.close()
+                # wait for reconnect in bootloader mode
+                device = wait_for_device(compatible_vidpids, self._find_bootloader, BOOTLOADER_TIMEOUT, watcher)
+            if device is None:
+                raise DeviceNotFoundError("Arduboy did not enter bootloader mode.")
+            port = device.port
+            self._active = True
+            self._print(f"Found {device.description} at port {port}")
+        self._port = port
+
+        self._print("Opening port ...", end="")
+        # the port may not be accessible immediately after it appears
+        deadline = time.time() + OPEN_TIMEOUT
+        interval = 0.01
+        with metrics.timer("connect.port_open"):
+            while True:
+                try:
+                    self.attach(Serial(port, 57600))
+                    break
+                except:
+                    if time.time() > deadline:
+                        self._print(" Failed!")
+                        raise BootLoaderError(f"Could not open port {port}.")
+                    metrics.count("connect.port_open_retries")
+                    self._print(".", end="")
+                    time.sleep(interval)
+                    interval = min(interval * 2, 0.4)
+        self._print("")
+
+    def _is_target(self, device):
+        if self._port is None:
+            return True
+        if self._location is not None and device.location == self._location:
+            return True
+        return device.port == self._port
+
+    def _find_device(self, devices):
+        for device in devices:
+            if self._is_target(device):
+                return device
+
+    def _find_bootloader(self, devices):
+        for device in devices:
+            if device.bootloader and self._is_target(device):
+                return device
+
+    @property
+    def port(self):
+        return self._port
+
+    def get_com_port(self, verbose):
+        device = self._find_device(find_devices(compatible_vidpids))
+        if device:
+            self._active = device.bootloader
+            if verbose: print(f"Found {device.description} at port {device.port}")
+            return device.port
+        if verbose: print("Arduboy not found.")
+
+    def attach(self, serial):
+        # use an already opened serial port (or an object behaving like one)
+        self._client = AsyncBootLoader(serial)
+
+    @property
+    def client(self):
+        # the AsyncBootLoader, for use from another event loop
+        return self._client
+
+    def _run(self, coroutine):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coroutine)
+
+    def _close_loop(self):
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        self._close_loop()
+
+    def exit(self):
+        # leaves the bootloader and closes the port. After a failed command the
+        # bootloader is out of sync and the port is only closed.
+        try:
+            if self._client is not None and not self._client.failed:
+                self._run(self._client.exit())
+        finally:
+            self.close()
+
+    def get_version(self):
+        return self._run(self._client.get_version())
+
+    def get_jedec_id(self):
+        try:
+            return self.read_jedec_id()
+        except BootLoaderError as e:
+            print(e)
+            delayed_exit()
+
+    def read_jedec_id(self):
+        # like get_jedec_id() but raises BootLoaderError when there is no flash cart
+        return self._run(self._client.read_jedec_id())
+
+    def set_led(self, control):
+        self._run(self._client.set_led(control))
+
+    def write(self, data: bytes):
+        return self._run(self._client.write(data))
+
+    def read(self, size):
+        return self._run(self._client.read(size))
+
+    def write_blocks(self, blocks, memtype, window=DEFAULT_WINDOW):
+        self._run(self._client.write_blocks(blocks, memtype, window))
+
+    def read_blocks(self, blocks, memtype, window=DEFAULT_WINDOW):
+        blocks = self._client.read_blocks(blocks, memtype, window)
+        try:
+            while True:
+                try:
+                    yield self._run(blocks.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(blocks.aclose())
+
+    def write_span(self, address, data, pagesize, memtype, window=DEFAULT_WINDOW):
+        self._run(self._client.write_span(address, data, pagesize, memtype, window))
+
+    def write_block(self, address, data, memtype):
+        self._run(self._client.write_block(address, data, memtype))
+
+    def read_block(self, address, length, memtype):
+        return self._run(self._client.read_block(address, length, memtype))
+
+    def has_checksum(self):
+        return self._run(self._client.has_checksum())
+
+    def checksums(self, blocks, memtype, window=DEFAULT_WINDOW):
+        return self._run(self._client.checksums(blocks, memtype, window))
+
+    def checksum(self, address, length, memtype):
+        return self._run(self._client.checksum(address, length, memtype))
+
+
+def delayed_exit():
+    time.sleep(2)
+    sys.exit()
@@ -0,0 +1,31 @@
+# Connecting to an Arduboy in bootloader mode and detecting its flash cart.
+
+from collections import namedtuple
+
+from arduboy.common import BootLoader, FlashCartError, manufacturers
+from arduboy.metrics import metrics
+
+FlashCart = namedtuple("FlashCart", "jedec_id manufacturer capacity")
+
+LED_OFF = 0xC0  # RGB LED off, buttons disabled
+LED_RED = 0xC2
+LED_BLUE = 0xC1
+LED_GREEN = 0x44  # RGB LED green, buttons enabled
+
+
+def connect(port=None, verbose=False):
+    # returns a BootLoader for the Arduboy at port, or the first one found when port is None.
+    # Raises DeviceNotFoundError or BootLoaderError.
+    bootloader = BootLoader(port, verbose)
+    bootloader.connect()
+    return bootloader
+
+
+def open_flashcart(bootloader):
+    # returns the FlashCart of the Arduboy. Raises FlashCartError when the bootloader has no
+    # flash cart support or no flash cart is detected.
+    if bootloader.get_version() < 13:
+        raise FlashCartError("Bootloader has no flash cart support")
+    with metrics.timer("flashcart.detect"):
+        jedec_id = bootloader.read_jedec_id()
+    return FlashCart(jedec_id, manufacturers.get(jedec_id[0], "unknown"), 1 << jedec_id[2])
@@ -0,0 +1,99 @@
+# Arduboy serial port discovery.
+# Compatible devices are matched with a VID:PID lookup table. Waiting for a device
+# to (dis)appear blocks on inotify events for /dev where available (Linux) and
+# otherwise polls the port list with an increasing interval.
+
+import ctypes
+import os
+import select
+import sys
+import time
+from collections import namedtuple
+
+from serial.tools.list_ports import comports
+
+POLL_INTERVAL_MIN = 0.02
+POLL_INTERVAL_MAX = 0.5
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+Device = namedtuple("Device", "port description bootloader location")
+
+
+def vidpid_table(devices):
+    # maps (vid, pid) to True for bootloader mode and False for sketch mode, from a
+    # list of "VID:PID=xxxx:xxxx" strings ordered as bootloader, sketch pairs
+    table = {}
+    for index, device in enumerate(devices):
+        vid, pid = device.split("=")[1].split(":")
+        table[(int(vid, 16), int(pid, 16))] = (index & 1) == 0
+    return table
+
+
+def find_devices(table):
+    # returns a Device for each compatible port. The USB location identifies a device
+    # when its port name changes after switching to bootloader mode.
+    return [Device(device.device, device.description, table[(device.vid, device.pid)], device.location)
+            for device in comports() if (device.vid, device.pid) in table]
+
+
+class DeviceWatcher:
+    def __init__(self):
+        self._fd = None
+        self._interval = POLL_INTERVAL_MIN
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0:
+                    if libc.inotify_add_watch(fd, b"/dev", IN_CREATE | IN_DELETE | IN_ATTRIB) >= 0:
+                        self._fd = fd
+                    else:
+                        os.close(fd)
+            except (OSError, AttributeError):
+                pass
+
+    def wait(self, timeout):
+        # returns when the device nodes may have changed or the timeout expired
+        if self._fd is not None:
+            # the timeout is capped in case an event was missed
+            if select.select([self._fd], [], [], min(timeout, POLL_INTERVAL_MAX))[0]:
+                try:
+                    while os.read(self._fd, 4096): pass
+                except BlockingIOError:
+                    pass
+            return
+        time.sleep(min(timeout, self._interval))
+        self._interval = min(self._interval * 2, POLL_INTERVAL_MAX)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def wait_for_device(table, condition, timeout, watcher=None):
+    # waits until condition(devices) returns a true value and returns that value,
+    # or None when the timeout expires
+    deadline = time.time() + timeout
+    own_watcher = watcher is None
+    if own_watcher:
+        watcher = DeviceWatcher()
+    try:
+        while True:
+            result = condition(find_devices(table))
+            remaining = deadline - time.time()
+            if result or remaining <= 0:
+                return result or None
+            watcher.wait(remaining)
+    finally:
+        if own_watcher:
+            watcher.close()
@@ -0,0 +1,17 @@
+# Backing up, restoring and erasing the Arduboy EEPROM.
+
+EEPROM_SIZE = 1024
+
+
+def backup_eeprom(bootloader):
+    return bootloader.read_block(0, EEPROM_SIZE, "E")
+
+
+def restore_eeprom(bootloader, data):
+    if len(data) != EEPROM_SIZE:
+        raise ValueError(f"EEPROM data must be {EEPROM_SIZE} bytes")
+    bootloader.write_block(0, data, "E")
+
+
+def erase_eeprom(bootloader):
+    bootloader.write_block(0, b"\xFF" * EEPROM_SIZE, "E")
@@ -0,0 +1,11 @@
+# Exceptions raised by the Arduboy python utilities. All of them derive from ArduboyError
+# so library users can catch every failure with a single except clause.
+
+
+class ArduboyError(Exception):
+    pass
+
+
+class VerifyError(ArduboyError):
+    # data read back differs from the data written
+    pass
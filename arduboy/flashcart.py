@@ -0,0 +1,395 @@
+# Writing and backing up flash cart contents.
+
+import json
+import mmap
+import os
+import queue
+import threading
+from collections import namedtuple
+
+from arduboy.device import LED_BLUE, LED_GREEN, LED_OFF, LED_RED
+from arduboy.errors import ArduboyError, VerifyError
+from arduboy.manifest import block_hash, block_hashes, cart_manifest_filename, load_manifest, manifest_filename, \
+    save_manifest, update_cart_manifest
+from arduboy.metrics import metrics
+from arduboy.sparseimage import SparseImageError, SparseImageWriter, read_sparse_blocks, read_sparse_header
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_FULL, VERIFY_NONE, select_verify_mode, verify_data
+
+PAGESIZE = 256
+BLOCKSIZE = 65536
+PAGES_PER_BLOCK = BLOCKSIZE // PAGESIZE
+MAX_PAGES = 65536
+
+lcdBootProgram = b"\xD5\xF0\x8D\x14\xA1\xC8\x81\xCF\xD9\xF1\xAF\x20\x00"
+
+WriteResult = namedtuple("WriteResult", "blocks skipped verify stale")
+BackupResult = namedtuple("BackupResult", "filename start length sparse")
+
+
+class BackupError(ArduboyError):
+    pass
+
+
+################################################################################
+# writing
+
+def patch_ssd1309(flashdata):
+    lcd_boot_program_addr = 0
+    while lcd_boot_program_addr >= 0:
+        lcd_boot_program_addr = flashdata.find(lcdBootProgram, lcd_boot_program_addr)
+        if lcd_boot_program_addr >= 0:
+            flashdata[lcd_boot_program_addr + 2] = 0xE3
+            flashdata[lcd_boot_program_addr + 3] = 0xE3
+
+
+def patched_blocks(blockdata):
+    # patches an image passed as blocks or page aligned chunks. Each block is passed on after
+    # searching the next one, so boot programs crossing a block boundary are patched too.
+    overlap = len(lcdBootProgram) - 1
+    previous = None
+    for data in blockdata:
+        data = bytearray(data)
+        if previous is None:
+            patch_ssd1309(data)
+        else:
+            tail = min(overlap, len(previous))
+            window = previous[len(previous) - tail:] + data
+            patch_ssd1309(window)
+            previous[len(previous) - tail:] = window[:tail]
+            data = window[tail:]
+            yield previous
+        previous = data
+    if previous is not None:
+        yield previous
+
+
+def pad_image(flashdata):
+    # pads image data to a multiple of PAGESIZE bytes
+    if len(flashdata) % PAGESIZE:
+        flashdata += b'\xFF' * (PAGESIZE - len(flashdata) % PAGESIZE)
+    return flashdata
+
+
+def development_layout(programdata, savedata):
+    # places program data and save data at the end of the flash cart. Returns the program
+    # data page, the save data page (MAX_PAGES when there is no save data) and the flash data.
+    programdata = pad_image(bytearray(programdata))
+    savedata = bytearray(savedata)
+    if len(savedata) % BLOCKSIZE:
+        savedata += b'\xFF' * (BLOCKSIZE - (len(savedata) % BLOCKSIZE))
+    savepage = MAX_PAGES - (len(savedata) // PAGESIZE)
+    programpage = savepage - (len(programdata) // PAGESIZE)
+    return programpage, savepage, programdata + savedata
+
+
+def image_blocks(bootloader, pagenumber, flashdata):
+    # splits flash data to be written at pagenumber into 64K blocks. Returns the block
+    # aligned page number, the number of blocks and a generator of the blocks. Whole blocks
+    # are memoryview slices of flashdata, partial head and tail blocks are separate buffers
+    # completed with the old flash cart contents when the block is reached.
+    view = memoryview(flashdata)
+    length = len(view)
+    head = pagenumber % PAGES_PER_BLOCK * PAGESIZE
+    blockaddr = pagenumber - pagenumber % PAGES_PER_BLOCK
+    blocks = (head + length + BLOCKSIZE - 1) // BLOCKSIZE
+
+    def generate():
+        for block in range(blocks):
+            start = block * BLOCKSIZE - head
+            end = start + BLOCKSIZE
+            if start >= 0 and end <= length:
+                yield view[start:end]
+                continue
+            address = blockaddr + block * PAGES_PER_BLOCK
+            data = bytearray()
+            # when starting partially in a block, preserve the beginning of old block data
+            if start < 0:
+                with metrics.timer("flashcart.partial_read", -start):
+                    data += bootloader.read_block(address, -start, "C")
+            data += view[max(start, 0):min(end, length)]
+            pad_image(data)
+            # when ending partially in a block, preserve the ending of old block data
+            if len(data) < BLOCKSIZE:
+                with metrics.timer("flashcart.partial_read", BLOCKSIZE - len(data)):
+                    data += bootloader.read_block(address + len(data) // PAGESIZE, BLOCKSIZE - len(data), "C")
+            yield data
+
+    return blockaddr, blocks, generate()
+
+
+def write_flashcart(bootloader, cart, pagenumber, flashdata, verify=False, diff=False, manifest=False,
+                    base_manifest=None, progress=None):
+    # writes flash data (any bytes like object) to the flash cart starting at pagenumber. The
+    # old data of partially written blocks is preserved. See program_blocks for the options.
+    blockaddr, blocks, blockdata = image_blocks(bootloader, pagenumber, flashdata)
+    return program_blocks(bootloader, cart, blockaddr, blockdata, blocks, verify, diff, manifest, base_manifest,
+                          progress)
+
+
+def write_flashcart_file(bootloader, cart, pagenumber, filename, patch=False, **options):
+    # writes an image file like write_flashcart without loading it. The file is memory mapped
+    # copy on write, so the SSD1309 patch (patch=True) does not change the file.
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return write_flashcart(bootloader, cart, pagenumber, b"", **options)
+        image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    try:
+        if patch:
+            patch_ssd1309(image)
+        return write_flashcart(bootloader, cart, pagenumber, image, **options)
+    finally:
+        try:
+            image.close()
+        except BufferError:
+            # block views are still referenced by an exception traceback, the mapping
+            # is closed when they are released
+            pass
+
+
+def stream_blocks(bootloader, pagenumber, chunks):
+    # like image_blocks for an iterable of page aligned chunks of unknown total size.
+    # Generates the 64K blocks, starting at the block aligned page number of pagenumber.
+    head = pagenumber % PAGES_PER_BLOCK * PAGESIZE
+    blockaddr = pagenumber - pagenumber % PAGES_PER_BLOCK
+    data = bytearray()
+    if head:
+        with metrics.timer("flashcart.partial_read", head):
+            data += bootloader.read_block(blockaddr, head, "C")
+    for chunk in chunks:
+        view = memoryview(chunk)
+        while view:
+            take = min(len(view), BLOCKSIZE - len(data))
+            data += view[:take]
+            view = view[take:]
+            if len(data) == BLOCKSIZE:
+                yield data
+                blockaddr += PAGES_PER_BLOCK
+                data = bytearray()
+    if data:
+        pad_image(data)
+        if len(data) < BLOCKSIZE:
+            with metrics.timer("flashcart.partial_read", BLOCKSIZE - len(data)):
+                data += bootloader.read_block(blockaddr + len(data) // PAGESIZE, BLOCKSIZE - len(data), "C")
+        yield data
+
+
+def prefetch(iterable, size):
+    # iterates iterable in a background thread, keeping up to size items ahead. Exceptions
+    # are raised in the consuming thread.
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def write_flashcart_stream(bootloader, cart, pagenumber, chunks, prefetch_chunks=16, **options):
+    # writes an iterable of page aligned chunks, such as arduboy.builder.build_stream, to the
+    # flash cart starting at pagenumber. The chunks are produced in a background thread, up
+    # to prefetch_chunks ahead, while blocks are written. As the number of blocks is not
+    # known in advance, progress(block, None) is called. See program_blocks for the options.
+    blockdata = stream_blocks(bootloader, pagenumber, prefetch(chunks, prefetch_chunks))
+    return program_blocks(bootloader, cart, pagenumber - pagenumber % PAGES_PER_BLOCK, blockdata, None, **options)
+
+
+def write_sparse_image(bootloader, cart, pagenumber, fileobj, patch=False, verify=False, diff=False, manifest=False,
+                       base_manifest=None, progress=None):
+    # writes a sparse image block by block to a block aligned page number
+    if pagenumber % PAGES_PER_BLOCK:
+        raise SparseImageError("sparse images can only be written to the start of a 64K block")
+    blocksize, blocks = read_sparse_header(fileobj)
+    if blocksize != BLOCKSIZE:
+        raise SparseImageError("unsupported block size")
+    blockdata = read_sparse_blocks(fileobj, blocksize)
+    if patch:
+        blockdata = patched_blocks(blockdata)
+    return program_blocks(bootloader, cart, pagenumber, blockdata, blocks, verify, diff, manifest, base_manifest,
+                          progress)
+
+
+def program_blocks(bootloader, cart, pagenumber, blockdata, blocks, verify=False, diff=False, manifest=False,
+                   base_manifest=None, progress=None):
+    # writes whole blocks starting at a block aligned page number and returns a WriteResult
+    # with the verify mode used.
+    # verify : verify each block after writing, raises VerifyError when it differs. A verify
+    #          mode of arduboy.verify, True for full read back.
+    # diff   : read each block first and skip it when it is unchanged
+    # manifest : skip blocks that are unchanged according to the manifest of the last image
+    #            written to or backed up from the flash cart, or base_manifest when given.
+    #            The manifest is kept per flash chip model (JEDEC ID), not per cart, so each
+    #            skipped block is checked by checksum (or read back when the bootloader has no
+    #            checksum support) and written when it differs. Those blocks are counted as
+    #            stale in the WriteResult.
+    # progress(block, blocks) is called before each block is written. blocks may be None.
+    firstblock = pagenumber // PAGES_PER_BLOCK
+    verify = select_verify_mode(bootloader, verify)
+    newblocks = []
+    knownblocks = None
+    if manifest or base_manifest:
+        knownblocks = load_manifest(base_manifest or cart_manifest_filename(cart.jedec_id), BLOCKSIZE)
+        # a sample of pages would miss most differences with another cart
+        check = VERIFY_NONE
+        if knownblocks:
+            check = VERIFY_CHECKSUM if bootloader.has_checksum() else VERIFY_FULL
+
+    skipped = 0
+    stale = 0
+    try:
+        for block, data in enumerate(blockdata):
+            # the block is unknown to the manifest until it is known to contain the new data
+            newblocks.append(None)
+            digest = block_hash(data)
+            bootloader.set_led(LED_OFF if block & 1 else LED_RED)
+            if progress: progress(block, blocks)
+            blockaddr = pagenumber + block * PAGES_PER_BLOCK
+            # skip blocks that already contain the same data
+            if knownblocks and firstblock + block < len(knownblocks) and knownblocks[firstblock + block] == digest:
+                with metrics.timer("flashcart.manifest_check", BLOCKSIZE):
+                    unchanged = verify_data(bootloader, blockaddr, data, "C", check, PAGESIZE, PAGESIZE, block)
+                if unchanged:
+                    newblocks[block] = digest
+                    skipped += 1
+                    metrics.count("flashcart.blocks_skipped")
+                    continue
+                stale += 1
+                metrics.count("flashcart.blocks_stale")
+            if diff:
+                with metrics.timer("flashcart.diff_read", BLOCKSIZE):
+                    unchanged = bootloader.read_block(blockaddr, BLOCKSIZE, "C") == data
+                if unchanged:
+                    newblocks[block] = digest
+                    skipped += 1
+                    metrics.count("flashcart.blocks_skipped")
+                    continue
+            # includes erasing and programming the block, the acknowledge follows when done
+            with metrics.timer("flashcart.block_write", BLOCKSIZE):
+                bootloader.write_block(blockaddr, data, "C")
+            if verify != VERIFY_NONE:
+                with metrics.timer("flashcart.verify", BLOCKSIZE):
+                    verified = verify_data(bootloader, blockaddr, data, "C", verify, PAGESIZE, PAGESIZE, block)
+                if not verified:
+                    raise VerifyError(f"Verify failed in block {firstblock + block}")
+            newblocks[block] = digest
+    finally:
+        # the blocks written so far are known to the manifest, even when writing failed
+        update_cart_manifest(cart.jedec_id, cart.capacity, firstblock, newblocks, BLOCKSIZE)
+    bootloader.set_led(LED_GREEN)
+    return WriteResult(len(newblocks), skipped, verify, stale)
+
+
+################################################################################
+# backup
+
+def journal_filename(filename):
+    return filename + ".journal"
+
+
+def load_journal(filename):
+    try:
+        with open(journal_filename(filename), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_journal(filename, journal):
+    tempname = journal_filename(filename) + ".tmp"
+    with open(tempname, "w") as f:
+        json.dump(journal, f)
+    os.replace(tempname, journal_filename(filename))
+
+
+def backup_flashcart(bootloader, cart, filename, start=0, length=None, compress=False, resume=False, progress=None):
+    # reads the flash cart to a (sparse compressed) image file and returns a BackupResult.
+    # Progress is recorded in a journal file so an interrupted backup can be resumed, in
+    # which case start, length and compress are taken from the journal.
+    # progress(block, blocks) is called after each block is saved.
+    jedec = bytes(cart.jedec_id).hex().upper()
+    journal = None
+    if resume:
+        journal = load_journal(filename)
+        if journal is None or not os.path.isfile(filename):
+            raise BackupError(f'No interrupted backup found for "{filename}".')
+        if journal["jedec_id"] != jedec:
+            raise BackupError("The interrupted backup was made from a different flash cart.")
+        start = journal["start"]
+        length = journal["length"]
+    if length is None:
+        length = cart.capacity - start
+    if start % BLOCKSIZE or length % BLOCKSIZE or length <= 0:
+        raise BackupError("Start and length must be multiples of 64K.")
+    if start + length > cart.capacity:
+        raise BackupError("Backup range exceeds the flash cart capacity.")
+    if journal is None:
+        journal = {"jedec_id": jedec, "start": start, "length": length, "sparse": compress,
+                   "blocks_done": 0, "file_offset": 0, "erased_run": 0}
+        with open(filename, "wb"):
+            pass
+        save_journal(filename, journal)
+
+    firstblock = start // BLOCKSIZE
+    blocks = length // BLOCKSIZE
+    with open(filename, "r+b") as binfile:
+        binfile.seek(journal["file_offset"])
+        binfile.truncate()
+        if journal["sparse"]:
+            sparse = SparseImageWriter(binfile, BLOCKSIZE, journal["blocks_done"], journal["erased_run"])
+        else:
+            sparse = None
+        for block in range(journal["blocks_done"], blocks):
+            bootloader.set_led(LED_OFF if block & 1 else LED_BLUE)
+            blockaddr = (firstblock + block) * PAGES_PER_BLOCK
+            with metrics.timer("flashcart.block_read", BLOCKSIZE):
+                contents = bootloader.read_block(blockaddr, BLOCKSIZE, "C")
+            if sparse:
+                sparse.write_block(contents)
+            else:
+                binfile.write(contents)
+            binfile.flush()
+            journal["blocks_done"] = block + 1
+            journal["file_offset"] = binfile.tell()
+            journal["erased_run"] = sparse.erased_run if sparse else 0
+            save_journal(filename, journal)
+            if progress: progress(block, blocks)
+        if sparse:
+            sparse.close()
+
+    bootloader.set_led(LED_GREEN)
+    os.remove(journal_filename(filename))
+    with open(filename, "rb") as binfile:
+        if journal["sparse"]:
+            hashes = [block_hash(data) for data in read_sparse_blocks(binfile, read_sparse_header(binfile)[0])]
+        else:
+            hashes = block_hashes(binfile.read(), BLOCKSIZE)
+    save_manifest(manifest_filename(filename), hashes, length, BLOCKSIZE, cart.jedec_id)
+    update_cart_manifest(cart.jedec_id, cart.capacity, firstblock, hashes, BLOCKSIZE)
+    return BackupResult(filename, start, length, journal["sparse"])
@@ -0,0 +1,81 @@
+# Intel HEX decoder shared by the uploader and the flash cart builder.
+# Each record is decoded in one go with bytes.fromhex and checked with a single sum.
+
+from arduboy.errors import ArduboyError
+
+FLASH_SIZE = 32768
+FLASH_PAGESIZE = 128
+
+RECORD_DATA = 0x00
+RECORD_EOF = 0x01
+RECORD_EXT_SEGMENT_ADDR = 0x02
+RECORD_EXT_LINEAR_ADDR = 0x04
+
+
+class HexFileError(ArduboyError):
+    pass
+
+
+def parse_hex_records(records, size=FLASH_SIZE, pagesize=FLASH_PAGESIZE):
+    # returns the flash image (unused bytes are 0xFF) and a list of used flash pages
+    buffer = bytearray(b'\xFF' * size)
+    page_used = [False] * (size // pagesize)
+    base_addr = 0
+    for linenumber, rcd in enumerate(records, 1):
+        rcd = rcd.strip()
+        if not rcd.startswith(":"): continue
+        try:
+            raw = bytes.fromhex(rcd[1:])
+        except ValueError:
+            raise HexFileError(f"invalid hex digits in line {linenumber}")
+        if len(raw) < 5 or len(raw) != raw[0] + 5:
+            raise HexFileError(f"invalid record length in line {linenumber}")
+        if sum(raw) & 0xFF:
+            raise HexFileError(f"checksum error in line {linenumber}")
+        rcd_len = raw[0]
+        rcd_typ = raw[3]
+        if rcd_typ == RECORD_DATA:
+            if rcd_len == 0: continue
+            flash_addr = base_addr + ((raw[1] << 8) | raw[2])
+            if flash_addr + rcd_len > size:
+                raise HexFileError(f"address {flash_addr:X} out of range in line {linenumber}")
+            buffer[flash_addr:flash_addr + rcd_len] = raw[4:-1]
+            for page in range(flash_addr // pagesize, (flash_addr + rcd_len - 1) // pagesize + 1):
+                page_used[page] = True
+        elif rcd_typ == RECORD_EOF:
+            break
+        elif rcd_typ in (RECORD_EXT_SEGMENT_ADDR, RECORD_EXT_LINEAR_ADDR) and rcd_len != 2:
+            raise HexFileError(f"invalid address record in line {linenumber}")
+        elif rcd_typ == RECORD_EXT_SEGMENT_ADDR:
+            base_addr = ((raw[4] << 8) | raw[5]) << 4
+        elif rcd_typ == RECORD_EXT_LINEAR_ADDR:
+            base_addr = ((raw[4] << 8) | raw[5]) << 16
+    return buffer, page_used
+
+
+def load_hex_file(filename, size=FLASH_SIZE, pagesize=FLASH_PAGESIZE):
+    with open(filename, "r") as f:
+        return parse_hex_records(f, size, pagesize)
+
+
+def used_ranges(page_used):
+    # returns (first page, page count) tuples for each run of consecutive used pages
+    ranges = []
+    first = None
+    for page, used in enumerate(page_used):
+        if used and first is None:
+            first = page
+        elif not used and first is not None:
+            ranges.append((first, page - first))
+            first = None
+    if first is not None:
+        ranges.append((first, len(page_used) - first))
+    return ranges
+
+
+def used_length(page_used, pagesize=FLASH_PAGESIZE):
+    # number of bytes up to and including the last used page
+    for page in range(len(page_used) - 1, -1, -1):
+        if page_used[page]:
+            return (page + 1) * pagesize
+    return 0
@@ -0,0 +1,83 @@
+# Conversion of images and sprite sheets to Arduboy drawing function data.
+
+import os
+
+from arduboy.bitmap import encode_sprites, has_transparency
+
+HEX_BYTES = [f"0x{b:02X}, " for b in range(256)]
+
+
+def parse_filename(filename):
+    # parse filename: FILENAME_[WxH]_[S].[EXT]"
+    sprite_width = 0
+    sprite_height = 0
+    spacing = 0
+    elements = os.path.basename(os.path.splitext(filename)[0]).lower().split("_")
+    last_element = len(elements) - 1
+    # get width and height from filename
+    i = last_element
+    while i > 0:
+        if "x" in elements[i]:
+            sprite_width = int(elements[i].split("x")[0])
+            sprite_height = int(elements[i].split("x")[1])
+            if i < last_element:
+                spacing = int(elements[i + 1])
+            break
+        else:
+            i -= 1
+    else:
+        i = last_element
+    # get sprite name (may contain underscores) from filename
+    sprite_name = "_".join(elements[:max(i, 1)])
+    return sprite_name, sprite_width, sprite_height, spacing
+
+
+def convert_image(filename):
+    sprite_name, sprite_width, sprite_height, spacing = parse_filename(filename)
+
+    # load image
+    from PIL import Image
+    img = Image.open(filename).convert("RGBA")
+    # check for transparency
+    transparency = has_transparency(img)
+
+    # check for multiple frames/tiles
+    if sprite_width > 0:
+        hframes = (img.size[0] - spacing) // (sprite_width + spacing)
+    else:
+        sprite_width = img.size[0] - 2 * spacing
+        hframes = 1
+    if sprite_height > 0:
+        vframes = (img.size[1] - spacing) // (sprite_height + spacing)
+    else:
+        sprite_height = img.size[1] - 2 * spacing
+        vframes = 1
+
+    # create byte array for bin file
+    data = encode_sprites(img, sprite_width, sprite_height, spacing, hframes, vframes, transparency)
+    buffer = bytearray([sprite_width >> 8, sprite_width & 0xFF, sprite_height >> 8, sprite_height & 0xFF])
+    buffer += data
+
+    # one line per 8 pixel high row of a frame, frames separated by an empty line
+    linelength = sprite_width * (2 if transparency else 1)
+    pages = (sprite_height + 7) // 8
+    lines = [f"  {''.join(map(HEX_BYTES.__getitem__, data[i:i + linelength]))}"
+             for i in range(0, len(data), linelength)]
+    if lines:
+        lines[-1] = lines[-1][:-2]
+    for line in range(len(lines) - pages, 0, -pages):
+        lines[line - 1] += "\n"
+    with open(os.path.splitext(filename)[0] + ".h", "w") as headerfile:
+        headerfile.write("\n")
+        headerfile.write(f"constexpr uint8_t {sprite_name}_width = {sprite_width};\n")
+        headerfile.write(f"constexpr uint8_t {sprite_name}_height = {sprite_height};\n")
+        headerfile.write("\n")
+        headerfile.write(f"const uint8_t PROGMEM {sprite_name}[] =\n")
+        headerfile.write("{\n")
+        headerfile.write(f"  {sprite_name}_width, {sprite_name}_height,\n")
+        headerfile.write("\n".join(lines) + "\n")
+        headerfile.write("};\n")
+
+    # save bytearray to file (temporary code for fx datafile creation)
+    with open(os.path.splitext(filename)[0] + ".bin", "wb") as binfile:
+        binfile.write(buffer)
@@ -0,0 +1,115 @@
+# Per block hash manifests for flash cart images.
+# A manifest lists a SHA-256 hash for every 64K block of an image. The
+# builder and backup tools write one next to each image, and the writer keeps
+# a manifest of the last known contents of each flash cart (by JEDEC ID) so it
+# can tell which blocks need programming without reading the cart first. The
+# JEDEC ID is shared by all carts of a chip model, so the writer still checks
+# the skipped blocks by checksum, or reads them back when the bootloader has no
+# checksum support.
+
+import hashlib
+import json
+import os
+import threading
+
+BLOCKSIZE = 65536
+MANIFEST_VERSION = 1
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".arduboy-python-utilities")
+
+# serializes updates of the cart manifests by devices written in parallel
+_cart_manifest_lock = threading.Lock()
+
+
+def block_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def block_hashes(data, blocksize=BLOCKSIZE):
+    view = memoryview(data)
+    return [block_hash(view[i:i + blocksize]) for i in range(0, len(data), blocksize)]
+
+
+class BlockHasher:
+    # computes the block hashes of data that is passed in pieces of any size
+    def __init__(self, blocksize=BLOCKSIZE):
+        self.blocksize = blocksize
+        self.hashes = []
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._used = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        while view:
+            take = min(len(view), self.blocksize - self._used)
+            self._hash.update(view[:take])
+            self._used += take
+            view = view[take:]
+            if self._used == self.blocksize:
+                self.hashes.append(self._hash.hexdigest())
+                self._hash = hashlib.sha256()
+                self._used = 0
+
+    def finish(self):
+        # returns the hashes, including that of a final partial block
+        if self._used:
+            self.hashes.append(self._hash.hexdigest())
+            self._hash = hashlib.sha256()
+            self._used = 0
+        return self.hashes
+
+
+def manifest_filename(imagefile):
+    return imagefile + ".manifest"
+
+
+def cart_manifest_filename(jedec_id):
+    return os.path.join(STATE_DIR, f"flashcart-{bytes(jedec_id).hex().upper()}.manifest")
+
+
+def save_manifest(filename, blocks, size, blocksize=BLOCKSIZE, jedec_id=None):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "blocksize": blocksize,
+        "size": size,
+        "blocks": blocks,
+    }
+    if jedec_id is not None:
+        manifest["jedec_id"] = bytes(jedec_id).hex().upper()
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tempname = f"{filename}.{os.getpid()}.tmp"
+    with open(tempname, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tempname, filename)
+
+
+def load_manifest(filename, blocksize=BLOCKSIZE):
+    # returns the list of block hashes (None for unknown blocks) or None if there is no usable manifest
+    try:
+        with open(filename, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("blocksize") != blocksize:
+        return None
+    return manifest["blocks"]
+
+
+def write_image_manifest(imagefile, data, blocksize=BLOCKSIZE):
+    save_manifest(manifest_filename(imagefile), block_hashes(data, blocksize), len(data), blocksize)
+
+
+def update_cart_manifest(jedec_id, capacity, first_block, blocks, blocksize=BLOCKSIZE):
+    # records the hashes of the blocks starting at first_block as the current contents of the cart
+    filename = cart_manifest_filename(jedec_id)
+    with _cart_manifest_lock:
+        known = load_manifest(filename, blocksize)
+        if known is None or len(known) != capacity // blocksize:
+            known = [None] * (capacity // blocksize)
+        for i, digest in enumerate(blocks):
+            if first_block + i < len(known):
+                known[first_block + i] = digest
+        save_manifest(filename, known, capacity, blocksize, jedec_id)
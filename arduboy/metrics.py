@@ -0,0 +1,144 @@
+# Instrumentation of serial transfers and tool phases.
+# Timers record call counts, bytes, latencies and a latency histogram, counters record
+# events like retries. Recording is disabled by default. Set the ARDUBOY_METRICS environment
+# variable to a filename to record and save the metrics when a tool exits, as JSON when the
+# filename ends with .json and in the Prometheus text format otherwise.
+
+import atexit
+import json
+import os
+import time
+
+METRICS_ENVIRONMENT = "ARDUBOY_METRICS"
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class TimerStats:
+    __slots__ = ("count", "total", "min", "max", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last bucket counts the slower ones
+
+    def add(self, seconds, nbytes):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        return {"count": self.count, "seconds": self.total, "min": self.min, "max": self.max, "bytes": self.bytes,
+                "histogram": dict(zip([str(bound) for bound in BUCKETS] + ["inf"], self.buckets))}
+
+
+class Timer:
+    # context manager timing a block. Set nbytes when the byte count is known afterwards.
+    __slots__ = ("metrics", "name", "nbytes", "start")
+
+    def __init__(self, metrics, name, nbytes):
+        self.metrics = metrics
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.nbytes)
+
+
+class NullTimer:
+    __slots__ = ("nbytes",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_null_timer = NullTimer()
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name, nbytes=0):
+        if not self.enabled:
+            return _null_timer
+        return Timer(self, name, nbytes)
+
+    def observe(self, name, seconds, nbytes=0):
+        if self.enabled:
+            stats = self.timers.get(name)
+            if stats is None:
+                stats = self.timers[name] = TimerStats()
+            stats.add(seconds, nbytes)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {"timers": {name: stats.to_dict() for name, stats in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items()))}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_text(self):
+        lines = []
+        for name, stats in sorted(self.timers.items()):
+            metric = "arduboy_" + name.replace(".", "_")
+            lines.append(f"# TYPE {metric}_seconds histogram")
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], stats.buckets):
+                cumulative += count
+                lines.append(f'{metric}_seconds_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_seconds_sum {stats.total:.6f}")
+            lines.append(f"{metric}_seconds_count {stats.count}")
+            if stats.bytes:
+                lines.append(f"# TYPE {metric}_bytes_total counter")
+                lines.append(f"{metric}_bytes_total {stats.bytes}")
+        for name, value in sorted(self.counters.items()):
+            metric = "arduboy_" + name.replace(".", "_")
+            lines.append(f"# TYPE {metric}_total counter")
+            lines.append(f"{metric}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.to_json() if filename.lower().endswith(".json") else self.to_text())
+
+
+metrics = Metrics()
+
+
+def enable_from_environment():
+    filename = os.environ.get(METRICS_ENVIRONMENT)
+    if filename and not metrics.enabled:
+        metrics.enabled = True
+        atexit.register(metrics.save, os.path.abspath(filename))
+
+
+enable_from_environment()
@@ -0,0 +1,132 @@
+# Uploading, backing up and erasing the sketch in the Arduboy flash memory.
+
+import zipfile
+from collections import namedtuple
+
+from arduboy.common import BootLoaderError
+from arduboy.errors import VerifyError
+from arduboy.hexfile import FLASH_PAGESIZE, HexFileError, parse_hex_records, used_ranges
+from arduboy.metrics import metrics
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_FULL, VERIFY_NONE, select_verify_mode, verify_data
+
+lcdBootProgram = b"\xD5\xF0\x8D\x14\xA1\xC8\x81\xCF\xD9\xF1\xAF\x20\x00"
+
+CATERINA_FIRST_PAGE = 224  # first flash page of the 4K Caterina bootloader
+SKETCH_SIZE = 0x7000
+
+Sketch = namedtuple("Sketch", "flash_data page_used name")
+
+
+def load_sketch(filename):
+    # returns the Sketch of a .hex file or of the hex file in a .arduboy or .zip file.
+    # Raises HexFileError.
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as compressed_file:
+            for name in compressed_file.namelist():
+                if name.lower().endswith(".hex"):
+                    records = compressed_file.read(name).decode().splitlines()
+                    break
+            else:
+                raise HexFileError("no hex file found")
+    else:
+        name = filename
+        with open(filename, "r") as f:
+            records = f.readlines()
+    flash_data, page_used = parse_hex_records(records)
+    return Sketch(flash_data, page_used, name)
+
+
+def patch_ssd1309(flash_data):
+    # patches the display initialisation for SSD1309 displays, returns False when not found
+    lcd_boot_program_addr = flash_data.find(lcdBootProgram)
+    if lcd_boot_program_addr < 0:
+        return False
+    flash_data[lcd_boot_program_addr + 2] = 0xE3
+    flash_data[lcd_boot_program_addr + 3] = 0xE3
+    return True
+
+
+def patch_micro_leds(flash_data):
+    # reverses the RX and TX LED polarity for Arduino / Genuino Micro
+    for i in range(0, len(flash_data) - 4, 2):
+        if flash_data[i:i + 2] == b'\x28\x98':  # RXLED1
+            flash_data[i + 1] = 0x9a
+        elif flash_data[i:i + 2] == b'\x28\x9a':  # RXLED0
+            flash_data[i + 1] = 0x98
+        elif flash_data[i:i + 2] == b'\x5d\x98':  # TXLED1
+            flash_data[i + 1] = 0x9a
+        elif flash_data[i:i + 2] == b'\x5d\x9a':  # TXLED0
+            flash_data[i + 1] = 0x98
+        elif flash_data[i:i + 4] == b'\x81\xef\x85\xb9':  # Arduboy core init RXLED port
+            flash_data[i] = 0x80
+        elif flash_data[i:i + 4] == b'\x84\xe2\x8b\xb9':  # Arduboy core init TXLED port
+            flash_data[i + 1] = 0xE0
+
+
+def check_bootloader_overwrite(bootloader, page_used):
+    # raises BootLoaderError when an unprotected Caterina bootloader would be overwritten
+    bootloader.write(b"V")  # get bootloader software version
+    if bootloader.read(2) == b"10":  # original caterina 1.0 bootloader
+        bootloader.write(b"r")  # read lock bits
+        if (ord(bootloader.read(1)) & 0x10 != 0) and any(page_used[CATERINA_FIRST_PAGE:]):
+            raise BootLoaderError("This upload will most likely corrupt the bootloader")
+
+
+def write_sketch(bootloader, flash_data, page_used, progress=None):
+    # used pages are written as contiguous spans (page address is a word address).
+    # progress(pages) is called after each span.
+    for first, count in used_ranges(page_used):
+        with metrics.timer("sketch.write", count * FLASH_PAGESIZE):
+            bootloader.write_span(first * 64, flash_data[first * FLASH_PAGESIZE: (first + count) * FLASH_PAGESIZE],
+                                  FLASH_PAGESIZE, "F")
+        if progress: progress(count)
+
+
+def verify_sketch(bootloader, flash_data, page_used, progress=None, verify=VERIFY_FULL):
+    # raises VerifyError with the address of the first page that differs, or with the
+    # address range of the span that differs for checksum and sample verify (see arduboy.verify).
+    # Returns the verify mode used.
+    mode = select_verify_mode(bootloader, verify)
+    flash_ranges = used_ranges(page_used)
+    with metrics.timer("sketch.verify", sum(count for first, count in flash_ranges) * FLASH_PAGESIZE):
+        if mode == VERIFY_FULL:
+            spans = bootloader.read_blocks(((first * 64, count * FLASH_PAGESIZE) for first, count in flash_ranges), "F")
+            try:
+                for (first, count), data in zip(flash_ranges, spans):
+                    for i in range(first, first + count):
+                        if (data[(i - first) * FLASH_PAGESIZE: (i - first + 1) * FLASH_PAGESIZE] !=
+                                flash_data[i * FLASH_PAGESIZE: (i + 1) * FLASH_PAGESIZE]):
+                            raise VerifyError(f"Verify failed at address {i * FLASH_PAGESIZE:04X}")
+                    if progress: progress(count)
+            finally:
+                spans.close()
+        elif mode != VERIFY_NONE:
+            for first, count in flash_ranges:
+                data = flash_data[first * FLASH_PAGESIZE: (first + count) * FLASH_PAGESIZE]
+                if not verify_data(bootloader, first * 64, data, "F", mode, FLASH_PAGESIZE, 2):
+                    raise VerifyError(f"Verify failed at address {first * FLASH_PAGESIZE:04X}-"
+                                      f"{(first + count) * FLASH_PAGESIZE - 1:04X}")
+                if progress: progress(count)
+    return mode
+
+
+def upload_sketch(bootloader, flash_data, page_used, verify=VERIFY_CHECKSUM):
+    # verify is a verify mode (see arduboy.verify), True for full read back or False
+    check_bootloader_overwrite(bootloader, page_used)
+    write_sketch(bootloader, flash_data, page_used)
+    verify_sketch(bootloader, flash_data, page_used, verify=verify)
+
+
+def backup_sketch(bootloader):
+    # returns the flash memory below the bootloader
+    return bootloader.read_block(0, SKETCH_SIZE, "F")
+
+
+def erase_sketch(bootloader):
+    # erases the first flash page so the bootloader will not start the sketch
+    bootloader.write(b"A\x00\x00")  # select page 0
+    bootloader.read(1)
+    bootloader.write(b"B\x00\x00F")  # writing 0 length block will erase page only
+    bootloader.read(1)
+    if bootloader.read_block(0, FLASH_PAGESIZE, "F") != b"\xFF" * FLASH_PAGESIZE:
+        raise VerifyError("Erase failed")
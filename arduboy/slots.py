@@ -0,0 +1,204 @@
+# Indexing flash cart images and reading and replacing single slots.
+# The slot headers written by the builder are chained by their next page field. The
+# indexer follows the chain reading only the 256 byte headers of an image file, a (sparse)
+# backup or a live flash cart. The slot table of an image file is cached in a .slots file
+# next to it, so slots can be read and replaced without reading the whole image.
+
+import json
+import os
+from collections import namedtuple
+
+from arduboy.builder import slot_header
+from arduboy.errors import ArduboyError
+from arduboy.flashcart import BLOCKSIZE, MAX_PAGES, PAGESIZE, pad_image, write_flashcart
+from arduboy.sparseimage import SparseImageReader, is_sparse_image
+
+SLOT_TABLE_VERSION = 1
+HEADER_MAGIC = b"ARDUBOY"
+HEADER_PAGES = 5  # the header page and 4 title screen pages
+TITLE_SIZE = 1024
+
+# pages are flash cart page numbers, sizes in bytes. programpage and datapage are None when
+# the slot has no program or data. The data size includes the padding up to the next slot.
+SlotInfo = namedtuple("SlotInfo", "number list page previouspage nextpage programpage programsize datapage datasize")
+SlotContents = namedtuple("SlotContents", "title program data")
+
+
+class SlotError(ArduboyError):
+    pass
+
+
+class ImageFile:
+    # page access to a flash cart image file. Sparse images can only be read.
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        self._sparse = None
+        if is_sparse_image(filename):
+            if writable:
+                raise SlotError("Slots of sparse images can not be replaced.")
+            self._file = open(filename, "rb")
+            self._sparse = SparseImageReader(self._file)
+        else:
+            self._file = open(filename, "r+b" if writable else "rb")
+
+    def read(self, page, length):
+        # returns up to length bytes, less at the end of the image
+        if self._sparse:
+            return self._sparse.read(page * PAGESIZE, length)
+        self._file.seek(page * PAGESIZE)
+        return self._file.read(length)
+
+    def write(self, page, data):
+        self._file.seek(page * PAGESIZE)
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CartImage:
+    # page access to the flash cart of a connected Arduboy. Writes rewrite only the 64K blocks
+    # covering the written pages, see arduboy.flashcart.write_flashcart for the options.
+    def __init__(self, bootloader, cart, verify=False, progress=None):
+        self.bootloader = bootloader
+        self.cart = cart
+        self.verify = verify
+        self.progress = progress
+        self.result = None
+
+    def read(self, page, length):
+        length = min(length, self.cart.capacity - page * PAGESIZE)
+        if length <= 0:
+            return b""
+        # the read command length is 16 bits, longer reads are split into 64K chunks
+        chunks = ((page + offset // PAGESIZE, min(BLOCKSIZE, length - offset))
+                  for offset in range(0, length, BLOCKSIZE))
+        return b"".join(self.bootloader.read_blocks(chunks, "C"))
+
+    def write(self, page, data):
+        self.result = write_flashcart(self.bootloader, self.cart, page, data, verify=self.verify,
+                                      progress=self.progress)
+
+
+def parse_header(header, number, page):
+    # returns the SlotInfo of a slot header or None when it is not a slot header
+    if len(header) < PAGESIZE or header[:len(HEADER_MAGIC)] != HEADER_MAGIC:
+        return None
+    previouspage = (header[8] << 8) | header[9]
+    nextpage = (header[10] << 8) | header[11]
+    programsize = header[14] * 128
+    programpage = (header[15] << 8) | header[16] if programsize else None
+    datapage = (header[17] << 8) | header[18]
+    if datapage == 0xFFFF:
+        datapage = None
+    datasize = (nextpage - datapage) * PAGESIZE if datapage is not None else 0
+    return SlotInfo(number, header[7], page, previouspage, nextpage, programpage, programsize, datapage, datasize)
+
+
+def scan_slots(image):
+    # returns the SlotInfo of each slot by following the header chain from page 0
+    slots = []
+    page = 0
+    while page < MAX_PAGES:
+        slot = parse_header(image.read(page, PAGESIZE), len(slots), page)
+        if slot is None:
+            break
+        if slot.nextpage <= page or (slot.datapage is not None and not page < slot.datapage < slot.nextpage):
+            raise SlotError(f"Slot {len(slots)} at page {page} has a corrupt header.")
+        slots.append(slot)
+        page = slot.nextpage
+    return slots
+
+
+################################################################################
+# slot table cache
+
+def slot_table_filename(filename):
+    return filename + ".slots"
+
+
+def save_slot_table(filename, slots):
+    stat = os.stat(filename)
+    table = {
+        "version": SLOT_TABLE_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "slots": [list(slot) for slot in slots],
+    }
+    tempname = slot_table_filename(filename) + ".tmp"
+    with open(tempname, "w") as f:
+        json.dump(table, f)
+    os.replace(tempname, slot_table_filename(filename))
+
+
+def load_slot_table(filename, cache=True):
+    # returns the SlotInfo list of an image file. The cached table is used when the image
+    # did not change since it was saved, otherwise the image is scanned and the table saved.
+    stat = os.stat(filename)
+    if cache:
+        try:
+            with open(slot_table_filename(filename), "r") as f:
+                table = json.load(f)
+            if (table["version"] == SLOT_TABLE_VERSION and table["size"] == stat.st_size and
+                    table["mtime"] == stat.st_mtime_ns):
+                return [SlotInfo(*slot) for slot in table["slots"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    with ImageFile(filename) as image:
+        slots = scan_slots(image)
+    if cache:
+        save_slot_table(filename, slots)
+    return slots
+
+
+################################################################################
+# slot access
+
+def find_slot(slots, number):
+    if not 0 <= number < len(slots):
+        raise SlotError(f"There is no slot {number}, the image has {len(slots)} slots.")
+    return slots[number]
+
+
+def read_slot(image, slot):
+    # returns the SlotContents of a slot, reading only the slot itself
+    title = image.read(slot.page + 1, TITLE_SIZE)
+    program = image.read(slot.programpage, slot.programsize) if slot.programpage is not None else b""
+    data = image.read(slot.datapage, slot.datasize) if slot.datapage is not None else b""
+    return SlotContents(title, program, data)
+
+
+def slot_pages(slot, title=None, program=None, data=None, image=None):
+    # returns the pages of a slot with new contents and the updated SlotInfo. Contents that
+    # are None are kept and read from image. The slot keeps its size, so the new program and
+    # data must fit in it. The data page is patched into the program like the builder does.
+    if title is None or program is None or data is None:
+        old = read_slot(image, slot)
+        title = old.title if title is None else title
+        program = old.program if program is None else program
+        data = old.data if data is None else data
+    if len(title) != TITLE_SIZE:
+        raise SlotError(f"A title screen must be {TITLE_SIZE} bytes.")
+    program = pad_image(bytearray(program))
+    data = pad_image(bytearray(data))
+    room = (slot.nextpage - slot.page - HEADER_PAGES) * PAGESIZE
+    if len(program) + len(data) > room:
+        raise SlotError(f"Slot {slot.number} has room for {room} bytes of program and data, "
+                        f"{len(program) + len(data)} bytes needed.")
+    header = slot_header(slot.list, slot.page, slot.previouspage, slot.nextpage, program, len(data))
+    contents = header + title + program + data
+    contents += b"\xFF" * ((slot.nextpage - slot.page) * PAGESIZE - len(contents))
+    return contents, parse_header(header, slot.number, slot.page)
+
+
+def replace_slot(image, slot, title=None, program=None, data=None):
+    # replaces the contents of a slot in an image (see slot_pages) and returns the new SlotInfo
+    contents, newslot = slot_pages(slot, title, program, data, image)
+    image.write(slot.page, contents)
+    return newslot
@@ -0,0 +1,149 @@
+# Sparse compressed flash cart image format.
+# Runs of erased (all 0xFF) blocks are stored as a block count and all other
+# blocks are zlib compressed one by one, so images can be written and read
+# back a block at a time without inflating them first.
+#
+# header : magic (8 bytes) version (1 byte) blocksize (4 bytes) blockcount (4 bytes)
+# records: b"F" count (4 bytes)            run of erased blocks
+#          b"Z" length (4 bytes) data      zlib compressed block
+
+import struct
+import zlib
+
+from arduboy.errors import ArduboyError
+
+MAGIC = b"ABSPARSE"
+VERSION = 1
+HEADER = struct.Struct("<8sBII")
+RECORD = struct.Struct("<cI")
+RECORD_ERASED = b"F"
+RECORD_COMPRESSED = b"Z"
+
+
+class SparseImageError(ArduboyError):
+    pass
+
+
+def is_sparse_image(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SparseImageWriter:
+    # writes blocks to a seekable file object. When resuming an interrupted image,
+    # pass the block count and erased run length recorded at the current file position.
+    def __init__(self, fileobj, blocksize, blockcount=0, erased_run=0):
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.blockcount = blockcount
+        self.erased_run = erased_run
+        self._erased = b"\xFF" * blocksize
+        if fileobj.tell() == 0:
+            fileobj.write(HEADER.pack(MAGIC, VERSION, blocksize, 0))
+
+    def write_block(self, data):
+        if len(data) != self.blocksize:
+            raise SparseImageError(f"block size must be {self.blocksize} bytes")
+        self.blockcount += 1
+        if data == self._erased:
+            self.erased_run += 1
+            return
+        self._flush_erased_run()
+        compressed = zlib.compress(data)
+        self.fileobj.write(RECORD.pack(RECORD_COMPRESSED, len(compressed)))
+        self.fileobj.write(compressed)
+
+    def _flush_erased_run(self):
+        if self.erased_run:
+            self.fileobj.write(RECORD.pack(RECORD_ERASED, self.erased_run))
+            self.erased_run = 0
+
+    def close(self):
+        self._flush_erased_run()
+        self.fileobj.seek(0)
+        self.fileobj.write(HEADER.pack(MAGIC, VERSION, self.blocksize, self.blockcount))
+        self.fileobj.seek(0, 2)
+
+
+def read_sparse_header(fileobj):
+    # returns the block size and block count of a sparse image
+    header = fileobj.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise SparseImageError("truncated sparse image header")
+    magic, version, blocksize, blockcount = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise SparseImageError("not a sparse flash cart image")
+    return blocksize, blockcount
+
+
+def read_sparse_blocks(fileobj, blocksize):
+    # yields the blocks of a sparse image positioned just after its header
+    erased = b"\xFF" * blocksize
+    while True:
+        record = fileobj.read(RECORD.size)
+        if not record:
+            return
+        if len(record) != RECORD.size:
+            raise SparseImageError("truncated sparse image record")
+        tag, value = RECORD.unpack(record)
+        if tag == RECORD_ERASED:
+            for _ in range(value):
+                yield erased
+        elif tag == RECORD_COMPRESSED:
+            data = zlib.decompress(fileobj.read(value))
+            if len(data) != blocksize:
+                raise SparseImageError("corrupt sparse image block")
+            yield data
+        else:
+            raise SparseImageError(f"unknown sparse image record {tag!r}")
+
+
+class SparseImageReader:
+    # random access to the blocks of a sparse image. The block table is built from the
+    # record headers only, blocks are decompressed when they are read.
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.blocksize, self.blockcount = read_sparse_header(fileobj)
+        self._blocks = []  # (file offset, length) of the compressed block or None when erased
+        while len(self._blocks) < self.blockcount:
+            record = fileobj.read(RECORD.size)
+            if len(record) != RECORD.size:
+                raise SparseImageError("truncated sparse image record")
+            tag, value = RECORD.unpack(record)
+            if tag == RECORD_ERASED:
+                self._blocks += [None] * value
+            elif tag == RECORD_COMPRESSED:
+                self._blocks.append((fileobj.tell(), value))
+                fileobj.seek(value, 1)
+            else:
+                raise SparseImageError(f"unknown sparse image record {tag!r}")
+        self._last = (None, None)
+
+    @property
+    def size(self):
+        return self.blocksize * self.blockcount
+
+    def read_block(self, block):
+        if self._last[0] == block:
+            return self._last[1]
+        location = self._blocks[block]
+        if location is None:
+            data = b"\xFF" * self.blocksize
+        else:
+            self.fileobj.seek(location[0])
+            data = zlib.decompress(self.fileobj.read(location[1]))
+            if len(data) != self.blocksize:
+                raise SparseImageError("corrupt sparse image block")
+        self._last = (block, data)
+        return data
+
+    def read(self, offset, length):
+        # returns up to length bytes at offset, less at the end of the image
+        result = bytearray()
+        end = min(offset + length, self.size)
+        while offset < end:
+            block, start = divmod(offset, self.blocksize)
+            data = self.read_block(block)[start:start + end - offset]
+            result += data
+            offset += len(data)
+        return bytes(result)
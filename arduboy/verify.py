@@ -0,0 +1,63 @@
+# Verifying written data without reading all of it back.
+# The checksum mode compares CRC32 checksums computed by the bootloader with those of the
+# written data. Bootloaders without the checksum command are verified by reading back a
+# sample of the pages instead. The full mode reads back all data.
+
+import zlib
+
+VERIFY_NONE = "none"
+VERIFY_CHECKSUM = "checksum"
+VERIFY_SAMPLE = "sample"
+VERIFY_FULL = "full"
+VERIFY_MODES = (VERIFY_NONE, VERIFY_CHECKSUM, VERIFY_SAMPLE, VERIFY_FULL)
+
+SAMPLE_STRIDE = 16  # every 16th page is read back in sample mode
+
+
+def verify_mode(verify):
+    # returns the mode of a verify argument. True selects full read back, False and None no verify.
+    if verify is True:
+        return VERIFY_FULL
+    if not verify:
+        return VERIFY_NONE
+    if verify not in VERIFY_MODES:
+        raise ValueError(f"Unknown verify mode '{verify}'")
+    return verify
+
+
+def select_verify_mode(bootloader, verify):
+    # like verify_mode, using sample mode when the bootloader has no checksum command
+    mode = verify_mode(verify)
+    if mode == VERIFY_CHECKSUM and not bootloader.has_checksum():
+        return VERIFY_SAMPLE
+    return mode
+
+
+def sample_offsets(length, pagesize, phase=0):
+    # offsets of every SAMPLE_STRIDE-th page starting at page phase and of the last page.
+    # Varying the phase between blocks spreads the samples over all page positions.
+    pages = (length + pagesize - 1) // pagesize
+    samples = list(range(phase % SAMPLE_STRIDE, pages, SAMPLE_STRIDE))
+    if pages and (not samples or samples[-1] != pages - 1):
+        samples.append(pages - 1)
+    return [page * pagesize for page in samples]
+
+
+def verify_data(bootloader, address, data, memtype, mode, pagesize, unit, phase=0):
+    # returns True when memtype memory at address contains data. unit is the number of
+    # bytes per address (2 for flash words, 256 for flash cart pages).
+    if mode == VERIFY_FULL:
+        return bootloader.read_block(address, len(data), memtype) == data
+    if mode == VERIFY_CHECKSUM:
+        return bootloader.checksum(address, len(data), memtype) == zlib.crc32(data)
+    if mode == VERIFY_SAMPLE:
+        offsets = sample_offsets(len(data), pagesize, phase)
+        pages = bootloader.read_blocks(((address + offset // unit, min(pagesize, len(data) - offset))
+                                        for offset in offsets), memtype)
+        try:
+            for offset, page in zip(offsets, pages):
+                if page != data[offset:offset + pagesize]:
+                    return False
+        finally:
+            pages.close()
+    return True
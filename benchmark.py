@@ -0,0 +1,422 @@
+# Benchmarks for the tools and their CPU heavy parts.
+# Device benchmarks run the tools end to end against the emulated bootloader (emulator.py)
+# on a pseudo terminal, CPU benchmarks use the example-flashcarts data. Results are saved
+# as JSON so they can be compared between releases. Device benchmark results include the
+# transfer and phase metrics (arduboy/metrics.py) of their last run.
+
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import runpy
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from getopt import getopt
+
+from PIL import Image
+
+from arduboy import bitmap, common, manifest
+from arduboy.builder import build_flashcart, image_filename
+from arduboy.hexfile import parse_hex_records
+from arduboy.metrics import metrics
+from arduboy.slots import load_slot_table
+from emulator import BootloaderEmulator, EmulatorPty
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_PATH = os.path.join(SCRIPT_PATH, "example-flashcarts", "example")
+DEFAULT_OUTPUT = "benchmark-results.json"
+
+benchmarks = []
+
+
+def benchmark(name, device=False):
+    # registers a benchmark function. It is called with the Context and returns the
+    # number of bytes processed (transferred for device benchmarks)
+    def register(function):
+        benchmarks.append((name, device, function))
+        return function
+    return register
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Context:
+    def __init__(self, workdir, emulator=None, port=None):
+        self.workdir = workdir
+        self.emulator = emulator
+        self.port = port
+        self.example = os.path.join(workdir, "example")
+        self.image = os.path.join(EXAMPLE_PATH, "flashcart-image.bin")
+        self.built_image = os.path.join(workdir, "built-image.bin")
+        self.slots_image = os.path.join(workdir, "slots-image.bin")
+        self.hexfiles = sorted(os.path.join(root, name) for root, dirs, files in os.walk(EXAMPLE_PATH)
+                               for name in files if name.lower().endswith(".hex"))
+        self.pngfiles = sorted(os.path.join(root, name) for root, dirs, files in os.walk(EXAMPLE_PATH)
+                               for name in files if name.lower().endswith(".png"))
+
+    def run_tool(self, script, *args):
+        # runs a tool as if started from the commandline and returns its output. The two
+        # second delay before exiting is skipped.
+        def exit_now():
+            raise SystemExit
+        output = io.StringIO()
+        argv = sys.argv
+        delayed_exit = common.delayed_exit
+        common.delayed_exit = exit_now
+        sys.argv = [script] + list(args)
+        try:
+            with contextlib.redirect_stdout(output):
+                runpy.run_path(os.path.join(SCRIPT_PATH, script), run_name="__main__")
+        except SystemExit:
+            pass
+        finally:
+            sys.argv = argv
+            common.delayed_exit = delayed_exit
+        return output.getvalue()
+
+
+################################################################################
+# device benchmarks
+
+def check_flashcart(context, image=None):
+    with open(image or context.image, "rb") as f:
+        image = f.read()
+    if context.emulator.memory["C"][:len(image)] != image:
+        raise BenchmarkError("flash cart contents differ from the image")
+    return len(image)
+
+
+@benchmark("flashcart-writer", device=True)
+def bench_flashcart_writer(context):
+    context.emulator.memory["C"][:] = b"\xFF" * len(context.emulator.memory["C"])
+    context.run_tool("flashcart-writer.py", context.image)
+    return check_flashcart(context)
+
+
+def write_verified(context, mode, checksum):
+    context.emulator.memory["C"][:] = b"\xFF" * len(context.emulator.memory["C"])
+    context.emulator.checksum = checksum
+    try:
+        output = context.run_tool("flashcart-writer.py", "-v", mode, context.image)
+    finally:
+        context.emulator.checksum = False
+    if "verified" not in output:
+        raise BenchmarkError(output.strip().splitlines()[-1])
+    return check_flashcart(context)
+
+
+@benchmark("flashcart-writer-verify-full", device=True)
+def bench_flashcart_writer_verify_full(context):
+    return write_verified(context, "full", False)
+
+
+@benchmark("flashcart-writer-verify-sample", device=True)
+def bench_flashcart_writer_verify_sample(context):
+    return write_verified(context, "sample", False)
+
+
+@benchmark("flashcart-writer-verify-checksum", device=True)
+def bench_flashcart_writer_verify_checksum(context):
+    return write_verified(context, "checksum", True)
+
+
+@benchmark("flashcart-build-and-write", device=True)
+def bench_flashcart_build_and_write(context):
+    # builds the example flash cart while writing it, the result must equal the prebuilt image
+    context.emulator.memory["C"][:] = b"\xFF" * len(context.emulator.memory["C"])
+    context.run_tool("flashcart-writer.py", os.path.join(context.example, "flashcart-index.csv"))
+    return check_flashcart(context, context.built_image)
+
+
+@benchmark("flashcart-backup", device=True)
+def bench_flashcart_backup(context):
+    length = (os.path.getsize(context.image) + 0xFFFF) & ~0xFFFF
+    filename = os.path.join(context.workdir, "backup.bin")
+    context.run_tool("flashcart-backup.py", "-l", str(length), "-o", filename)
+    with open(filename, "rb") as f:
+        if f.read() != context.emulator.memory["C"][:length]:
+            raise BenchmarkError("backup differs from the flash cart contents")
+    return length
+
+
+@benchmark("sketch-upload", device=True)
+def bench_sketch_upload(context):
+    hexfile = max(context.hexfiles, key=os.path.getsize)
+    output = context.run_tool("uploader.py", "-v", "full", hexfile)
+    if "Upload success" not in output:
+        raise BenchmarkError(output.strip().splitlines()[-1])
+    with open(hexfile, "r") as f:
+        flash_data, flash_page_used = parse_hex_records(f.readlines())
+    # written and read back for verification
+    return 2 * 128 * sum(flash_page_used)
+
+
+@benchmark("sketch-backup", device=True)
+def bench_sketch_backup(context):
+    context.run_tool("sketch-backup.py")
+    return 32768 - 4096
+
+
+@benchmark("eeprom-backup", device=True)
+def bench_eeprom_backup(context):
+    context.run_tool("eeprom-backup.py")
+    return 1024
+
+
+@benchmark("eeprom-restore", device=True)
+def bench_eeprom_restore(context):
+    filename = os.path.join(context.workdir, "eeprom.bin")
+    with open(filename, "wb") as f:
+        f.write(bytes(range(256)) * 4)
+    context.run_tool("eeprom-restore.py", filename)
+    if context.emulator.memory["E"] != bytes(range(256)) * 4:
+        raise BenchmarkError("EEPROM contents differ from the restored file")
+    return 1024
+
+
+def build_slots_image(context):
+    # the example flash cart with an extra game slot holding more than 64K of data
+    if not os.path.isfile(context.slots_image):
+        datafile = os.path.join(context.example, "large-data.bin")
+        with open(datafile, "wb") as f:
+            f.write(bytes((i + i // 256) & 0xFF for i in range(150000)))  # differs on every page
+        csvfile = os.path.join(context.example, "slots-index.csv")
+        shutil.copyfile(os.path.join(context.example, "flashcart-index.csv"), csvfile)
+        with open(csvfile, "a", newline="") as f:
+            csv.writer(f, quotechar='"', delimiter=";").writerow(
+                ["7", "Large data", os.path.join("Shooter", "Night-Raid.png"),
+                 os.path.join("Shooter", "Night-Raid.hex"), "large-data.bin", ""])
+        build_flashcart(csvfile, context.slots_image, cache=False)
+    return load_slot_table(context.slots_image)[-1]
+
+
+@benchmark("flashcart-slots-replace", device=True)
+def bench_flashcart_slots_replace(context):
+    # replaces the title screen of a slot with more than 64K of data on the flash cart. The
+    # program and data are read back from the cart, the result must equal the same
+    # replacement in an image file.
+    slot = build_slots_image(context)
+    with open(context.slots_image, "rb") as f:
+        image = f.read()
+    context.emulator.memory["C"][:] = b"\xFF" * len(context.emulator.memory["C"])
+    context.emulator.memory["C"][:len(image)] = image
+    title = os.path.join(context.example, "Action", "Sansan.png")
+    output = context.run_tool("flashcart-slots.py", "-c", "-r", str(slot.number), "-t", title)
+    if "replaced" not in output:
+        raise BenchmarkError(output.strip().splitlines()[-1])
+    reference = os.path.join(context.workdir, "slots-reference.bin")
+    shutil.copyfile(context.slots_image, reference)
+    context.run_tool("flashcart-slots.py", "-n", "-r", str(slot.number), "-t", title, reference)
+    check_flashcart(context, reference)
+    # the blocks covering the slot are read and written
+    return 2 * ((slot.nextpage * 256 + 0xFFFF) // 0x10000 - slot.page * 256 // 0x10000) * 0x10000
+
+
+################################################################################
+# builder and CPU benchmarks
+
+def builder_image(context, output):
+    if "Error" in output:
+        raise BenchmarkError(output.strip().splitlines()[-1])
+    with open(os.path.join(context.example, "flashcart-image.bin"), "rb") as f:
+        return len(f.read())
+
+
+@benchmark("flashcart-builder")
+def bench_flashcart_builder(context):
+    output = context.run_tool("flashcart-builder.py", "-n", os.path.join(context.example, "flashcart-index.csv"))
+    return builder_image(context, output)
+
+
+@benchmark("flashcart-builder-cached")
+def bench_flashcart_builder_cached(context):
+    output = context.run_tool("flashcart-builder.py", os.path.join(context.example, "flashcart-index.csv"))
+    return builder_image(context, output)
+
+
+@benchmark("flashcart-builder-variants")
+def bench_flashcart_builder_variants(context):
+    # 8 images from one index in one run, the assets are decoded once for all of them
+    csvfile = os.path.join(context.example, "flashcart-index.csv")
+    csvfiles = [os.path.join(context.example, f"variant{number}-index.csv") for number in range(8)]
+    for filename in csvfiles:
+        shutil.copyfile(csvfile, filename)
+    output = context.run_tool("flashcart-builder.py", "-n", *csvfiles)
+    if "Error" in output:
+        raise BenchmarkError(output.strip().splitlines()[-1])
+    return sum(os.path.getsize(image_filename(filename)) for filename in csvfiles)
+
+
+@benchmark("hex-parse")
+def bench_hex_parse(context):
+    size = 0
+    for filename in context.hexfiles:
+        with open(filename, "r") as f:
+            records = f.readlines()
+        parse_hex_records(records)
+        size += sum(len(record) for record in records)
+    return size
+
+
+@benchmark("title-pack")
+def bench_title_pack(context):
+    size = 0
+    for filename in context.pngfiles:
+        img = Image.open(filename)
+        if img.size == (128, 64):
+            size += len(bitmap.pack_pages(img))
+    return size
+
+
+@benchmark("sprite-encode")
+def bench_sprite_encode(context):
+    # the title screens are used as sheets of 16 x 16 pixel sprites with and without mask
+    size = 0
+    for filename in context.pngfiles:
+        img = Image.open(filename).convert("RGBA")
+        if img.size == (128, 64):
+            for transparency in (False, True):
+                size += len(bitmap.encode_sprites(img, 16, 16, 0, 8, 4, transparency))
+    return size
+
+
+################################################################################
+
+def prepare_example(context):
+    # copy of the example flash cart with paths in the index file using the local separator
+    shutil.copytree(EXAMPLE_PATH, context.example)
+    csvfile = os.path.join(context.example, "flashcart-index.csv")
+    with open(csvfile, "r") as f:
+        rows = list(csv.reader(f, quotechar='"', delimiter=";"))
+    with open(csvfile, "w", newline="") as f:
+        writer = csv.writer(f, quotechar='"', delimiter=";")
+        for row in rows:
+            writer.writerow([cell.replace("\\", os.sep) for cell in row])
+    # image built by this version of the builder, the included image is older
+    build_flashcart(csvfile, context.built_image, cache=False)
+
+
+def run_benchmarks(selected, repeat, latency, bandwidth):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        emulator = BootloaderEmulator(latency=latency, bandwidth=bandwidth)
+        server = None
+        if any(device for name, device, function in selected):
+            try:
+                server = EmulatorPty(emulator)
+            except ImportError:
+                print("Pseudo terminals are not supported, skipping device benchmarks.")
+        context = Context(workdir, emulator, server.port if server else None)
+        prepare_example(context)
+        cwd = os.getcwd()
+        port = os.environ.get(common.PORT_ENVIRONMENT)
+        state_dir = manifest.STATE_DIR
+        metrics_enabled = metrics.enabled
+        os.chdir(workdir)
+        manifest.STATE_DIR = os.path.join(workdir, "state")
+        if server:
+            os.environ[common.PORT_ENVIRONMENT] = server.port
+        try:
+            for name, device, function in selected:
+                if device and not server:
+                    continue
+                result = {"name": name, "device": device}
+                times = []
+                try:
+                    for _ in range(repeat):
+                        metrics.enabled = device or metrics_enabled
+                        metrics.reset()
+                        starttime = time.perf_counter()
+                        size = function(context)
+                        times.append(time.perf_counter() - starttime)
+                except BenchmarkError as e:
+                    result["error"] = str(e)
+                if times:
+                    result.update({"runs": len(times), "bytes": size, "min": min(times), "median": statistics.median(times),
+                                   "mean": statistics.mean(times), "throughput": size / min(times) / 1024})
+                if device:
+                    result["metrics"] = metrics.to_dict()
+                results.append(result)
+                if "error" in result:
+                    print(f"{name:32} FAILED: {result['error']}")
+                else:
+                    print(f"{name:32} {result['min']:9.4f} {result['median']:9.4f} {result['throughput']:12.1f}")
+        finally:
+            os.chdir(cwd)
+            manifest.STATE_DIR = state_dir
+            metrics.enabled = metrics_enabled
+            if port is None:
+                os.environ.pop(common.PORT_ENVIRONMENT, None)
+            else:
+                os.environ[common.PORT_ENVIRONMENT] = port
+            if server:
+                server.close()
+    return results
+
+
+def usage():
+    print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [-r repeat] [-l latency] [-b bandwidth] [-k name] [-o results.json]")
+    print()
+    print("-r --repeat     Number of runs of each benchmark (default: 3)")
+    print("-l --latency    Emulated bootloader response latency in milliseconds (default: 0)")
+    print("-b --bandwidth  Emulated link speed in Kbyte per second (default: unlimited)")
+    print("-k --filter     Only run benchmarks whose name contains the given text")
+    print(f"-o --output     Results file (default: {DEFAULT_OUTPUT})")
+    print()
+    print("Benchmarks: " + ", ".join(name for name, device, function in benchmarks))
+    sys.exit()
+
+
+def main():
+    try:
+        opts, args = getopt(sys.argv[1:], "hr:l:b:k:o:", ["repeat=", "latency=", "bandwidth=", "filter=", "output="])
+    except:
+        usage()
+    if args:
+        usage()
+    repeat = 3
+    latency = 0.0
+    bandwidth = None
+    filters = []
+    output = DEFAULT_OUTPUT
+    for o, a in opts:
+        if o in ('-r', '--repeat'):
+            repeat = max(1, int(a))
+        elif o in ('-l', '--latency'):
+            latency = float(a) / 1000
+        elif o in ('-b', '--bandwidth'):
+            bandwidth = float(a) * 1024
+        elif o in ('-k', '--filter'):
+            filters.append(a)
+        elif o in ('-o', '--output'):
+            output = a
+        else:
+            usage()
+    selected = [entry for entry in benchmarks if not filters or any(text in entry[0] for text in filters)]
+    print("Benchmark                              Min    Median  Speed (KB/s)")
+    print("-------------------------------- --------- --------- ------------")
+    results = run_benchmarks(selected, repeat, latency, bandwidth)
+    with open(output, "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": bitmap.numpy is not None,
+            "repeat": repeat,
+            "latency": latency,
+            "bandwidth": bandwidth,
+            "results": results,
+        }, f, indent=2)
+    print(f'\nResults saved to "{output}"')
+
+
+if __name__ == '__main__':
+    print("\nArduboy python utilities benchmark\n")
+    main()
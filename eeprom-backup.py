@@ -1,6 +1,7 @@
 import time
 
-from common import delayed_exit, BootLoader
+from arduboy.common import BootLoader
+from arduboy.eeprom import backup_eeprom
 
 
 def main():
@@ -8,17 +9,13 @@ def main():
     bootloader.start()
     filename = time.strftime("eeprom-backup-%Y%m%d-%H%M%S.bin", time.localtime())
     print("Reading 1K EEPROM data...")
-    bootloader.write(b"A\x00\x00")
-    bootloader.read(1)
-    bootloader.write(b"g\x04\x00E")
-    eepromdata = bytearray(bootloader.read(1024))
+    eepromdata = backup_eeprom(bootloader)
     print(f'saving 1K EEPROM data to "{filename}"')
     f = open(filename, "wb")
     f.write(eepromdata)
     f.close()
     print("Done")
     bootloader.exit()
-    delayed_exit()
 
 
 if __name__ == '__main__':
@@ -1,18 +1,14 @@
-from common import delayed_exit, BootLoader
+from arduboy.common import BootLoader
+from arduboy.eeprom import erase_eeprom
 
 
 def main():
     bootloader = BootLoader()
     bootloader.start()
     print("Erasing EEPROM data...")
-    bootloader.write(b"A\x00\x00")
-    bootloader.read(1)
-    bootloader.write(b"B\x04\x00E")
-    bootloader.write(bytearray("\xFF" * 1024))
-    bootloader.read(1)
+    erase_eeprom(bootloader)
     bootloader.exit()
     print("Erase complete.")
-    delayed_exit()
 
 
 if __name__ == '__main__':
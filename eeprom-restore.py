@@ -1,7 +1,8 @@
 import os
 import sys
 
-from common import delayed_exit, BootLoader
+from arduboy.common import delayed_exit, BootLoader
+from arduboy.eeprom import EEPROM_SIZE, restore_eeprom
 
 
 def main():
@@ -19,7 +20,7 @@ def main():
     eepromdata = bytearray(f.read())
     f.close()
 
-    if len(eepromdata) != 1024:
+    if len(eepromdata) != EEPROM_SIZE:
         print("File does not contain 1K (1024 bytes) of EEPROM data\nRestore aborted")
         delayed_exit()
 
@@ -27,14 +28,9 @@ def main():
     bootloader = BootLoader()
     bootloader.start()
     print("Restoring EEPROM data...")
-    bootloader.write(b"A\x00\x00")
-    bootloader.read(1)
-    bootloader.write(b"B\x04\x00E")
-    bootloader.write(eepromdata)
-    bootloader.read(1)
+    restore_eeprom(bootloader, eepromdata)
     bootloader.exit()
     print("Done")
-    delayed_exit()
 
 
 if __name__ == '__main__':
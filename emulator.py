@@ -0,0 +1,331 @@
+# Emulated Arduboy bootloader for testing and benchmarking the tools without an Arduboy.
+# It speaks the Caterina / Cathy protocol subset used by BootLoader and can model the
+# latency and bandwidth of the USB CDC link.
+#
+# With checksum=True the bootloader also supports the checksum command extension ('h',
+# see arduboy/aiobootloader.py).
+#
+# The emulator can be used in process through EmulatedSerial (BootLoader.attach) or on
+# POSIX systems through a pseudo terminal. Tools connect to the pseudo terminal when the
+# ARDUBOY_PORT environment variable is set to its name:
+#
+#   python emulator.py -l 1 -b 500 &
+#   ARDUBOY_PORT=/dev/pts/3 python flashcart-writer.py flashcart-image.bin
+
+import os
+import select
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from getopt import getopt
+
+FLASH_SIZE = 32768
+FLASH_PAGESIZE = 128
+BOOTLOADER_SIZE = 4096
+EEPROM_SIZE = 1024
+CART_PAGESIZE = 256
+DEFAULT_JEDEC_ID = b"\xEF\x40\x18"  # Winbond 16MB
+LOCK_BITS_PROTECTED = 0xEF  # BLB11 programmed, bootloader section cannot be written
+
+
+class BootloaderEmulator:
+    def __init__(self, version=13, jedec_id=DEFAULT_JEDEC_ID, flash_size=FLASH_SIZE, eeprom_size=EEPROM_SIZE,
+                 cart_size=None, lock_bits=LOCK_BITS_PROTECTED, latency=0.0, bandwidth=None, checksum=False):
+        # latency is the delay in seconds before each response and bandwidth the link
+        # speed in bytes per second in each direction (None for unlimited). A version
+        # below 13 or a jedec_id of None emulates a bootloader without flash cart support.
+        self.version = version
+        self.jedec_id = bytes(jedec_id) if jedec_id is not None else None
+        self.lock_bits = lock_bits
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.checksum = checksum
+        if cart_size is None:
+            cart_size = 1 << self.jedec_id[2] if self.jedec_id is not None else 0
+        self.memory = {
+            "F": bytearray(b"\xFF" * flash_size),
+            "E": bytearray(b"\xFF" * eeprom_size),
+            "C": bytearray(b"\xFF" * cart_size),
+        }
+        self.address = 0
+        self.led = None
+        self.exits = 0
+        self.commands = 0
+        self._checksum_acked = False
+        self._input = bytearray()
+        self._output = deque()  # (time available, data)
+        self._rx_time = 0.0
+        self._tx_time = 0.0
+        self._lock = threading.Condition()
+
+    ############################################################################
+    # link model
+
+    def receive(self, data):
+        # data sent to the bootloader by the host
+        with self._lock:
+            now = time.monotonic()
+            self._rx_time = max(self._rx_time, now)
+            if self.bandwidth:
+                self._rx_time += len(data) / self.bandwidth
+            self._input += data
+            self._process()
+
+    def _respond(self, data):
+        ready = max(self._rx_time + self.latency, self._tx_time)
+        if self.bandwidth:
+            ready += len(data) / self.bandwidth
+        self._tx_time = ready
+        self._output.append((ready, bytes(data)))
+        self._lock.notify_all()
+
+    def available(self):
+        # number of response bytes the host can read now
+        with self._lock:
+            now = time.monotonic()
+            return sum(len(data) for ready, data in self._output if ready <= now)
+
+    def next_response_time(self):
+        with self._lock:
+            return self._output[0][0] if self._output else None
+
+    def transmit(self, size, timeout=None):
+        # returns up to size response bytes, waiting for them until timeout (None waits forever)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        result = bytearray()
+        with self._lock:
+            while len(result) < size:
+                now = time.monotonic()
+                if self._output and self._output[0][0] <= now:
+                    ready, data = self._output.popleft()
+                    take = size - len(result)
+                    result += data[:take]
+                    if len(data) > take:
+                        self._output.appendleft((ready, data[take:]))
+                    continue
+                if deadline is not None and now >= deadline:
+                    break
+                wait = self._output[0][0] - now if self._output else None
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._lock.wait(wait)
+        return bytes(result)
+
+    ############################################################################
+    # protocol
+
+    def _scale(self, memtype):
+        # bytes per address unit
+        return {"F": 2, "E": 1, "C": CART_PAGESIZE}[memtype]
+
+    def _process(self):
+        data = self._input
+        while data:
+            command = chr(data[0])
+            if command == "A":
+                if len(data) < 3: return
+                self.address = (data[1] << 8) | data[2]
+                del data[:3]
+                self._respond(b"\r")
+            elif command in "Bg":
+                if len(data) < 4: return
+                length = (data[1] << 8) | data[2]
+                memtype = chr(data[3])
+                if memtype not in self.memory or (memtype == "C" and not self._cart_support()):
+                    del data[:4]
+                    self._respond(b"?")
+                elif command == "B":
+                    if memtype == "F" and length == 0:
+                        # a 0 length flash write erases the page only
+                        del data[:4]
+                        self._write("F", self.address * 2, b"\xFF" * FLASH_PAGESIZE)
+                        self._respond(b"\r")
+                    else:
+                        length = length or 65536
+                        if len(data) < 4 + length: return
+                        self._write(memtype, self.address * self._scale(memtype), data[4:4 + length])
+                        del data[:4 + length]
+                        self.address += length // self._scale(memtype)
+                        self._respond(b"\r")
+                else:
+                    length = length or 65536
+                    del data[:4]
+                    start = self.address * self._scale(memtype)
+                    memory = self.memory[memtype]
+                    self._respond(memory[start:start + length].ljust(length, b"\xFF"))
+                    self.address += length // self._scale(memtype)
+            elif command == "h" and self.checksum:
+                # acknowledged before the length and memory type are received
+                if not self._checksum_acked:
+                    self._checksum_acked = True
+                    self._respond(b"\r")
+                if len(data) < 4: return
+                self._checksum_acked = False
+                length = ((data[1] << 8) | data[2]) or 65536
+                memtype = chr(data[3])
+                del data[:4]
+                start = self.address * self._scale(memtype)
+                checksum = zlib.crc32(self.memory[memtype][start:start + length].ljust(length, b"\xFF"))
+                self._respond(checksum.to_bytes(4, "big"))
+                self.address += length // self._scale(memtype)
+            elif command == "x":
+                if len(data) < 2: return
+                self.led = data[1]
+                del data[:2]
+                self._respond(b"\r")
+            elif command == "V":
+                del data[:1]
+                self._respond(f"{self.version:02}".encode())
+            elif command == "j":
+                del data[:1]
+                self._respond(self.jedec_id if self._cart_support() else b"\x00\x00\x00")
+            elif command == "r":
+                del data[:1]
+                self._respond(bytes([self.lock_bits]))
+            elif command == "E":
+                del data[:1]
+                self.exits += 1
+                self._respond(b"\r")
+            else:
+                del data[:1]
+                self._respond(b"?")
+            self.commands += 1
+
+    def _cart_support(self):
+        return self.version >= 13 and self.jedec_id is not None
+
+    def _write(self, memtype, start, data):
+        memory = self.memory[memtype]
+        end = min(start + len(data), len(memory))
+        if memtype == "F" and self.lock_bits & 0x10 == 0:
+            # protected bootloader section is not written
+            end = min(end, len(memory) - BOOTLOADER_SIZE)
+        if end > start:
+            memory[start:end] = data[:end - start]
+
+
+class EmulatedSerial:
+    # in process serial port connected to an emulator, usable with BootLoader.attach
+    def __init__(self, emulator, timeout=None):
+        self.emulator = emulator
+        self.timeout = timeout
+        self.is_open = True
+
+    def write(self, data):
+        self.emulator.receive(data)
+        return len(data)
+
+    def read(self, size=1):
+        return self.emulator.transmit(size, self.timeout)
+
+    @property
+    def in_waiting(self):
+        return self.emulator.available()
+
+    def close(self):
+        self.is_open = False
+
+
+class EmulatorPty:
+    # serves an emulator on the slave side of a pseudo terminal (POSIX only)
+    def __init__(self, emulator):
+        import pty
+        import tty
+        self.emulator = emulator
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        pending = b""
+        while self._running:
+            if not pending:
+                ready = self.emulator.next_response_time()
+                now = time.monotonic()
+                if ready is not None and ready <= now:
+                    pending = self.emulator.transmit(self.emulator.available(), 0)
+                timeout = 0.1 if ready is None else max(0.0, min(ready - now, 0.1))
+            else:
+                timeout = 0.1
+            readable, writable, _ = select.select([self._master], [self._master] if pending else [], [], timeout)
+            if readable:
+                try:
+                    self.emulator.receive(os.read(self._master, 65536))
+                except OSError:
+                    return
+            if writable:
+                pending = pending[os.write(self._master, pending):]
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+
+################################################################################
+
+def usage():
+    print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [-v version] [-j jedecid] [-l latency] [-b bandwidth] [-c] [-i image.bin]")
+    print()
+    print("Serves an emulated Arduboy bootloader on a pseudo terminal until Ctrl+C is pressed.")
+    print("Set the ARDUBOY_PORT environment variable to the shown port to use it with the tools.")
+    print()
+    print("-v --version    Bootloader version (default: 13, use 10 for Caterina without flash cart support)")
+    print("-j --jedec      Flash cart JEDEC ID in hex (default: EF4018)")
+    print("-l --latency    Response latency in milliseconds (default: 0)")
+    print("-b --bandwidth  Link speed in Kbyte per second (default: unlimited)")
+    print("-c --checksum   Support the checksum command extension")
+    print("-i --image      Load the flash cart contents from a file")
+    sys.exit()
+
+
+def main():
+    try:
+        opts, args = getopt(sys.argv[1:], "hv:j:l:b:ci:", ["version=", "jedec=", "latency=", "bandwidth=", "checksum", "image="])
+    except:
+        usage()
+    if args:
+        usage()
+    options = {}
+    image = None
+    for o, a in opts:
+        if o in ('-v', '--version'):
+            options["version"] = int(a)
+        elif o in ('-j', '--jedec'):
+            options["jedec_id"] = bytes.fromhex(a)
+        elif o in ('-l', '--latency'):
+            options["latency"] = float(a) / 1000
+        elif o in ('-b', '--bandwidth'):
+            options["bandwidth"] = float(a) * 1024
+        elif o in ('-c', '--checksum'):
+            options["checksum"] = True
+        elif o in ('-i', '--image'):
+            image = a
+        else:
+            usage()
+    emulator = BootloaderEmulator(**options)
+    if image is not None:
+        with open(image, "rb") as f:
+            data = f.read(len(emulator.memory["C"]))
+        emulator.memory["C"][:len(data)] = data
+    server = EmulatorPty(emulator)
+    print(f"Emulated bootloader at port {server.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    print(f"\n{emulator.commands} commands processed")
+
+
+if __name__ == '__main__':
+    print("\nArduboy bootloader emulator\n")
+    main()
@@ -1,7 +1,12 @@
+import os
 import sys
 import time
+from getopt import getopt
 
-from common import delayed_exit, BootLoader, manufacturers
+from arduboy.common import delayed_exit, BootLoader
+from arduboy.device import open_flashcart
+from arduboy.errors import ArduboyError
+from arduboy.flashcart import BLOCKSIZE, backup_flashcart, load_journal
 
 # requires pyserial to be installed. Use "python -m pip install pyserial" on commandline
 
@@ -13,65 +18,105 @@ except:
     print("Use 'python -m pip install pyserial' from the commandline to install.")
     sys.exit()
 
-PAGESIZE = 256
-BLOCKSIZE = 65536
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+def usage():
+    print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [-c] [-s start] [-l length] [-o backupfile.bin]")
+    print(f"{os.path.basename(sys.argv[0])} -r backupfile.bin")
+    print()
+    print("-s --start   Start address of the backup (default: 0)")
+    print("-l --length  Number of bytes to backup (default: up to the end of the flash cart)")
+    print("-o --output  Backup file name (default: a time stamped file name)")
+    print("-r --resume  Resume an interrupted backup from its last completed block")
+    print("-c --compress  Save a sparse compressed image. Erased blocks are stored as runs and")
+    print("             other blocks are compressed.")
+    print()
+    print("Start and length must be multiples of 64K (65536 or 0x10000 bytes).")
+    delayed_exit()
 
 
 def main():
+    try:
+        opts, args = getopt(sys.argv[1:], "hs:l:o:r:c", ["start=", "length=", "output=", "resume=", "compress"])
+    except:
+        usage()
+    if args:
+        usage()
+    start = 0
+    length = None
+    filename = None
+    resume = False
+    compress = False
+    for o, a in opts:
+        if o in ('-s', '--start'):
+            start = int(a, 0)
+        elif o in ('-l', '--length'):
+            length = int(a, 0)
+        elif o in ('-o', '--output'):
+            filename = a
+        elif o in ('-r', '--resume'):
+            filename = a
+            resume = True
+        elif o in ('-c', '--compress'):
+            compress = True
+        else:
+            usage()
+    if start % BLOCKSIZE or (length is not None and (length % BLOCKSIZE or length <= 0)):
+        print("Start and length must be multiples of 64K.")
+        delayed_exit()
+
+    if resume:
+        journal = load_journal(filename)
+        if journal is None or not os.path.isfile(filename):
+            print(f'No interrupted backup found for "{filename}".')
+            delayed_exit()
+
     bootloader = BootLoader()
     bootloader.start()
-
-    # check version
-    if bootloader.get_version() < 13:
-        print("Bootloader has no flash cart support\nWrite aborted!")
+    try:
+        cart = open_flashcart(bootloader)
+    except ArduboyError as e:
+        print(f"{e}\nBackup aborted!")
         delayed_exit()
-
-    # detect flash cart
-    jedec_id = bootloader.get_jedec_id()
-    if jedec_id[0] in manufacturers.keys():
-        manufacturer = manufacturers[jedec_id[0]]
+    print(f"\nFlash cart JEDEC ID    : {bytes(cart.jedec_id).hex().upper()}")
+    print(f"Flash cart Manufacturer: {cart.manufacturer}")
+    print(f"Flash cart capacity    : {cart.capacity // 1024} Kbyte\n")
+
+    if filename is None:
+        extension = ".sparse" if compress else ".bin"
+        filename = time.strftime("flashcart-backup-image-%Y%m%d-%H%M%S", time.localtime()) + extension
+    if resume:
+        print(f'Resuming backup to file "{filename}" at block {journal["blocks_done"] + 1}\n')
     else:
-        manufacturer = "unknown"
-    capacity = 1 << jedec_id[2]
-    print(f"\nFlash cart JEDEC ID    : {jedec_id[0]:02X}{jedec_id[1]:02X}{jedec_id[2]:02X}")
-    print(f"Flash cart Manufacturer: {manufacturer}")
-    print(f"Flash cart capacity    : {capacity // 1024} Kbyte\n")
-
-    filename = time.strftime("flashcart-backup-image-%Y%m%d-%H%M%S.bin", time.localtime())
-    print(f'Writing flash image to file: "{filename}"\n')
+        print(f'Writing flash image to file: "{filename}"\n')
 
     oldtime = time.time()
-    blocks = capacity // BLOCKSIZE
-    with open(filename, "wb") as binfile:
-        for block in range(0, blocks):
-            if block & 1:
-                bootloader.write(b"x\xC0")  # RGB BLUE OFF, buttons disabled
-            else:
-                bootloader.write(b"x\xC1")  # RGB BLUE RED, buttons disabled
-            bootloader.read(1)
-            sys.stdout.write(f"\rReading block {block + 1}/{blocks}")
-
-            blockaddr = block * BLOCKSIZE // PAGESIZE
-
-            bootloader.write(b"A")
-            bootloader.write(bytearray([blockaddr >> 8, blockaddr & 0xFF]))
-            bootloader.read(1)
-
-            blocklen = BLOCKSIZE
-
-            bootloader.write(b"g")
-            bootloader.write(bytearray([(blocklen >> 8) & 0xFF, blocklen & 0xFF]))
-
-            bootloader.write(b"C")
-            contents = bootloader.read(blocklen)
-            binfile.write(contents)
-
-    bootloader.write(b"x\x44")  # RGB LED GREEN, buttons enabled
-    bootloader.read(1)
+    resumed = None
+
+    def progress(block, blocks):
+        # report throughput and estimated time remaining
+        nonlocal resumed
+        if resumed is None:
+            resumed = block
+        elapsed = time.time() - oldtime
+        speed = (block + 1 - resumed) * BLOCKSIZE / elapsed / 1024 if elapsed > 0 else 0
+        eta = (blocks - block - 1) * BLOCKSIZE / 1024 / speed if speed > 0 else 0
+        sys.stdout.write(f"\rReading block {block + 1}/{blocks}  {speed:7.1f} KB/s  ETA {format_duration(eta)}")
+        sys.stdout.flush()
+
+    try:
+        backup_flashcart(bootloader, cart, filename, start, length, compress, resume, progress)
+    except ArduboyError as e:
+        print(f"\n{e}\nBackup aborted!")
+        bootloader.exit()
+        delayed_exit()
     time.sleep(0.5)
     bootloader.exit()
     print(f"\n\nDone in {round(time.time() - oldtime, 2)} seconds")
-    delayed_exit()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+from getopt import getopt
+
+from arduboy.bitmap import unpack_pages
+from arduboy.builder import load_data_file, load_hex_file_data, load_title_screen_data
+from arduboy.common import delayed_exit, BootLoader
+from arduboy.device import open_flashcart
+from arduboy.errors import ArduboyError
+from arduboy.slots import TITLE_SIZE, CartImage, ImageFile, find_slot, load_slot_table, read_slot, replace_slot, \
+    save_slot_table, scan_slots
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_MODES, VERIFY_NONE
+
+
+def usage():
+    print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [-n] image.bin")
+    print(f"{os.path.basename(sys.argv[0])} -x slot [-o name] image.bin")
+    print(f"{os.path.basename(sys.argv[0])} -r slot [-t title.png] [-p program.hex] [-d data.bin] image.bin")
+    print(f"{os.path.basename(sys.argv[0])} -c [-x slot | -r slot ... [-v mode]]")
+    print()
+    print("Lists the slots of a flash cart image or backup (also sparse images).")
+    print()
+    print("-x --extract   Save the title screen, program and data of a slot to name-title.png,")
+    print("               name-program.bin and name-data.bin")
+    print("-o --output    Name of the extracted files (default: the image name and slot number)")
+    print("-r --replace   Replace the title screen, program and/or data of a slot. The new")
+    print("               program and data must fit in the slot.")
+    print("-t --title     New title screen (128 x 64 pixels)")
+    print("-p --program   New program hex file")
+    print("-d --data      New data file")
+    print("-n --no-cache  Scan the image instead of using the cached slot table (.slots file)")
+    print("-c --cart      Use the flash cart of a connected Arduboy instead of an image file.")
+    print("               Replacing a slot only rewrites the 64K blocks the slot covers.")
+    print("-v --verify    Verify the rewritten flash cart blocks: none, checksum (default),")
+    print("               sample or full (see flashcart-writer.py)")
+    delayed_exit()
+
+
+def print_slots(slots):
+    print("Slot List  Page  Prev  Next ProgSize DataSize")
+    print("---- ---- ----- ----- ----- -------- --------")
+    for slot in slots:
+        print(f"{slot.number:4} {slot.list:4} {slot.page:5} {slot.previouspage:5} {slot.nextpage:5} "
+              f"{slot.programsize:8} {slot.datasize:8}")
+    print(f"\n{len(slots)} slots, {(slots[-1].nextpage + 3) // 4 if slots else 0} Kbyte used.")
+
+
+def extract_slot(image, slot, name):
+    contents = read_slot(image, slot)
+    unpack_pages(contents.title[:TITLE_SIZE], 128, 64).save(f"{name}-title.png")
+    print(f'Saved title screen to "{name}-title.png"')
+    if contents.program:
+        with open(f"{name}-program.bin", "wb") as f:
+            f.write(contents.program)
+        print(f'Saved program to "{name}-program.bin"')
+    if contents.data:
+        with open(f"{name}-data.bin", "wb") as f:
+            f.write(contents.data)
+        print(f'Saved data to "{name}-data.bin"')
+
+
+def progress(block, blocks):
+    sys.stdout.write(f"\rWriting block {block + 1}/{blocks}")
+
+
+def load_contents(titlefile, programfile, datafile):
+    # returns the new title screen, program and data of a slot (None when not replaced)
+    for filename in (titlefile, programfile, datafile):
+        if filename is not None and not os.path.isfile(filename):
+            raise ArduboyError(f"File not found. [{filename}]")
+    title = load_title_screen_data(os.path.abspath(titlefile)) if titlefile else None
+    program = load_hex_file_data(os.path.abspath(programfile)) if programfile else None
+    data = load_data_file(os.path.abspath(datafile)) if datafile else None
+    return title, program, data
+
+
+def main():
+    try:
+        opts, args = getopt(sys.argv[1:], "hx:o:r:t:p:d:ncv:", ["extract=", "output=", "replace=", "title=",
+                                                                 "program=", "data=", "no-cache", "cart", "verify="])
+    except:
+        usage()
+    extract = None
+    replace = None
+    name = None
+    titlefile = programfile = datafile = None
+    cache = True
+    cart = False
+    verify = VERIFY_CHECKSUM
+    for o, a in opts:
+        if o in ('-x', '--extract'):
+            extract = int(a, 0)
+        elif o in ('-o', '--output'):
+            name = a
+        elif o in ('-r', '--replace'):
+            replace = int(a, 0)
+        elif o in ('-t', '--title'):
+            titlefile = a
+        elif o in ('-p', '--program'):
+            programfile = a
+        elif o in ('-d', '--data'):
+            datafile = a
+        elif o in ('-n', '--no-cache'):
+            cache = False
+        elif o in ('-c', '--cart'):
+            cart = True
+        elif o in ('-v', '--verify') and a in VERIFY_MODES:
+            verify = a
+        else:
+            usage()
+    if len(args) != (0 if cart else 1) or (extract is not None and replace is not None):
+        usage()
+    if replace is not None and titlefile is None and programfile is None and datafile is None:
+        usage()
+
+    bootloader = None
+    try:
+        if replace is not None:
+            contents = load_contents(titlefile, programfile, datafile)
+        if cart:
+            bootloader = BootLoader()
+            bootloader.start()
+            image = CartImage(bootloader, open_flashcart(bootloader), verify, progress)
+            print("Reading slot headers...\n")
+            slots = scan_slots(image)
+            if name is None:
+                name = "flashcart-slot"
+        else:
+            filename = args[0]
+            if not os.path.isfile(filename):
+                print(f"File not found. [{filename}]")
+                delayed_exit()
+            slots = load_slot_table(filename, cache)
+            if name is None:
+                name = os.path.splitext(filename)[0] + "-slot"
+            image = ImageFile(filename, writable=replace is not None)
+
+        if extract is not None:
+            extract_slot(image, find_slot(slots, extract), f"{name}-{extract}")
+        elif replace is not None:
+            oldtime = time.time()
+            slots[replace] = replace_slot(image, find_slot(slots, replace), *contents)
+            if cart:
+                print()
+                if image.result.verify != VERIFY_NONE:
+                    print(f"Written blocks verified ({image.result.verify}).")
+            else:
+                image.close()
+                if cache:
+                    save_slot_table(filename, slots)
+            print(f"Slot {replace} replaced in {round(time.time() - oldtime, 2)} seconds.\n")
+            print_slots(slots)
+        else:
+            print_slots(slots)
+    except ArduboyError as e:
+        print(f"\nError: {e}")
+        if bootloader:
+            bootloader.exit()
+        delayed_exit()
+    if bootloader:
+        bootloader.exit()
+
+
+if __name__ == '__main__':
+    print("\nArduboy flash cart slot tool\n")
+    main()
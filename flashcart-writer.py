@@ -3,7 +3,15 @@ import sys
 import time
 from getopt import getopt
 
-from common import delayed_exit, BootLoader, manufacturers
+from arduboy.builder import build_stream
+from arduboy.common import delayed_exit, BootLoader
+from arduboy.device import open_flashcart
+from arduboy.errors import ArduboyError, VerifyError
+from arduboy.flashcart import MAX_PAGES, development_layout, patched_blocks, write_flashcart, write_flashcart_file, \
+    write_flashcart_stream, write_sparse_image
+from arduboy.manifest import cart_manifest_filename, load_manifest
+from arduboy.sparseimage import is_sparse_image
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_MODES, VERIFY_NONE, VERIFY_SAMPLE
 
 try:
     from serial.tools.list_ports import comports
@@ -13,90 +21,65 @@ except:
     print("Use 'python -m pip install pyserial' from the commandline to install.")
     sys.exit()
 
-PAGESIZE = 256
 BLOCKSIZE = 65536
-PAGES_PER_BLOCK = BLOCKSIZE // PAGESIZE
-MAX_PAGES = 65536
 
-lcdBootProgram = b"\xD5\xF0\x8D\x14\xA1\xC8\x81\xCF\xD9\xF1\xAF\x20\x00"
-verifyAfterWrite = False
+verifyAfterWrite = VERIFY_NONE
+differentialWrite = False
+manifestWrite = False
+baseManifest = None
 
 
 ################################################################################
 
-def write_flash(pagenumber, flashdata):
-    global verifyAfterWrite
+def start_flash_cart():
     bootloader = BootLoader()
     bootloader.start()
-
-    # check version
-    if bootloader.get_version() < 13:
-        print("Bootloader has no flash cart support\nWrite aborted!")
+    try:
+        cart = open_flashcart(bootloader)
+    except ArduboyError as e:
+        print(f"{e}\nWrite aborted!")
         delayed_exit()
+    print(f"\nFlash cart JEDEC ID    : {bytes(cart.jedec_id).hex().upper()}")
+    print(f"Flash cart Manufacturer: {cart.manufacturer}")
+    print(f"Flash cart capacity    : {cart.capacity // 1024} Kbyte\n")
+    if manifestWrite and load_manifest(baseManifest or cart_manifest_filename(cart.jedec_id), BLOCKSIZE) is None:
+        print("No manifest of the flash cart contents found, writing all blocks.\n")
+    return bootloader, cart
 
-    # detect flash cart
-    jedec_id = bootloader.get_jedec_id()
-    if jedec_id[0] in manufacturers.keys():
-        manufacturer = manufacturers[jedec_id[0]]
+
+def progress(block, blocks):
+    if blocks is None:
+        sys.stdout.write(f"\rWriting block {block + 1}")
     else:
-        manufacturer = "unknown"
-    capacity = 1 << jedec_id[2]
-    print(f"\nFlash cart JEDEC ID    : {jedec_id[0]:02X}{jedec_id[1]:02X}{jedec_id[2]:02X}")
-    print(f"Flash cart Manufacturer: {manufacturer}")
-    print(f"Flash cart capacity    : {capacity // 1024} Kbyte\n")
+        sys.stdout.write(f"\rWriting block {block + 1}/{blocks}")
 
+
+def write_image(write, *args, **kwargs):
+    # writes to the flash cart using one of the arduboy.flashcart write functions
+    bootloader, cart = start_flash_cart()
     oldtime = time.time()
-    # when starting partially in a block, preserve the beginning of old block data
-    if pagenumber % PAGES_PER_BLOCK:
-        blocklen = pagenumber % PAGES_PER_BLOCK * PAGESIZE
-        blockaddr = pagenumber // PAGES_PER_BLOCK * PAGES_PER_BLOCK
-        # read partial block data start
-        bootloader.write(bytearray([ord("A"), blockaddr >> 8, blockaddr & 0xFF]))
-        bootloader.read(1)
-        bootloader.write(bytearray([ord("g"), (blocklen >> 8) & 0xFF, blocklen & 0xFF, ord("C")]))
-        flashdata = bootloader.read(blocklen) + flashdata
-        pagenumber = blockaddr
-
-    # when ending partially in a block, preserve the ending of old block data
-    if len(flashdata) % BLOCKSIZE:
-        blocklen = BLOCKSIZE - len(flashdata) % BLOCKSIZE
-        blockaddr = pagenumber + len(flashdata) // PAGESIZE
-        # read partial block data end
-        bootloader.write(bytearray([ord("A"), blockaddr >> 8, blockaddr & 0xFF]))
-        bootloader.read(1)
-        bootloader.write(bytearray([ord("g"), (blocklen >> 8) & 0xFF, blocklen & 0xFF, ord("C")]))
-        flashdata += bootloader.read(blocklen)
-
-    # write to flash cart
-    blocks = len(flashdata) // BLOCKSIZE
-    for block in range(blocks):
-        if block & 1:
-            bootloader.write(b"x\xC0")  # RGB LED OFF, buttons disabled
-        else:
-            bootloader.write(b"x\xC2")  # RGB LED RED, buttons disabled
-        bootloader.read(1)
-        sys.stdout.write(f"\rWriting block {block + 1}/{blocks}")
-        blockaddr = pagenumber + block * BLOCKSIZE // PAGESIZE
-        blocklen = BLOCKSIZE
-        # write block
-        bootloader.write(bytearray([ord("A"), blockaddr >> 8, blockaddr & 0xFF]))
-        bootloader.read(1)
-        bootloader.write(bytearray([ord("B"), (blocklen >> 8) & 0xFF, blocklen & 0xFF, ord("C")]))
-        bootloader.write(flashdata[block * BLOCKSIZE: block * BLOCKSIZE + blocklen])
-        bootloader.read(1)
-        if verifyAfterWrite:
-            bootloader.write(bytearray([ord("A"), blockaddr >> 8, blockaddr & 0xFF]))
-            bootloader.read(1)
-            bootloader.write(bytearray([ord("g"), (blocklen >> 8) & 0xFF, blocklen & 0xFF, ord("C")]))
-            if bootloader.read(blocklen) != flashdata[block * BLOCKSIZE: block * BLOCKSIZE + blocklen]:
-                print(" verify failed!\n\nWrite aborted.")
-                break
-
-    # write complete
-    bootloader.write(b"x\x44")  # RGB LED GREEN, buttons enabled
-    bootloader.read(1)
+    try:
+        result = write(bootloader, cart, *args, verify=verifyAfterWrite, diff=differentialWrite,
+                       manifest=manifestWrite, base_manifest=baseManifest, progress=progress, **kwargs)
+    except VerifyError:
+        print(" verify failed!\n\nWrite aborted.")
+        bootloader.exit()
+        delayed_exit()
+    except ArduboyError as e:
+        print(f"\n{e}\nWrite aborted.")
+        bootloader.exit()
+        delayed_exit()
     time.sleep(0.5)
     bootloader.exit()
+    if differentialWrite or manifestWrite:
+        print(f"\n\n{result.skipped} of {result.blocks} blocks unchanged and skipped.", end="")
+    if result.stale:
+        print(f"\n\nWarning: {result.stale} blocks did not match the manifest and were written. The manifest"
+              "\nmay be of another flash cart of the same type.", end="")
+    if verifyAfterWrite == VERIFY_CHECKSUM and result.verify == VERIFY_SAMPLE:
+        print("\n\nBootloader has no checksum support, a sample of the pages was verified instead.", end="")
+    elif result.verify != VERIFY_NONE:
+        print(f"\n\nWritten blocks verified ({result.verify}).", end="")
     print(f"\n\nDone in {round(time.time() - oldtime, 2)} seconds")
 
 
@@ -104,26 +87,54 @@ def write_flash(pagenumber, flashdata):
 
 def usage():
     print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [pagenumber] flashdata.bin")
+    print(f"{os.path.basename(sys.argv[0])} [pagenumber] flashcart-index.csv")
     print(f"{os.path.basename(sys.argv[0])} [-d datafile.bin] [-s savefile.bin | -z savesize]")
     print()
     print("[pagenumber]   Write flashdata.bin to flash starting at pagenumber. When no")
     print("               pagenumber is specified, page 0 is used instead.")
+    print("               A flash cart index file (.csv) is built while it is written.")
     print("-d --datafile  Write datafile to end of flash for development.")
     print("-s --savefile  Write savedata to end of flash for development.")
     print("-z --savesize  Creates blank savedata (all 0xFF) at end of flash for development")
+    print("-D --diff      Read back each block first and only write blocks that changed.")
+    print("-M --manifest  Only write blocks that differ from the last image written to or")
+    print("               backed up from a flash cart with the same JEDEC ID. Skipped blocks")
+    print("               are checked by checksum (or read back when the bootloader has no checksum")
+    print("               support) and written when they differ.")
+    print("-B --base-manifest  Like --manifest but compare with the given manifest file.")
+    print("-v --verify    Verify each block after writing: none, checksum (compare checksums")
+    print("               computed by the bootloader, a sample of pages is read back when the")
+    print("               bootloader has no checksum support), sample or full (read back all")
+    print("               data). Default: none, or checksum when the script name contains verify.")
     delayed_exit()
 
 
 ################################################################################
 
 def main():
-    global verifyAfterWrite
+    global verifyAfterWrite, differentialWrite, manifestWrite, baseManifest
     try:
-        opts, args = getopt(sys.argv[1:], "hd:s:z:", ["datafile=", "savefile=", "savesize="])
+        opts, args = getopt(sys.argv[1:], "hd:s:z:DMB:v:",
+                            ["datafile=", "savefile=", "savesize=", "diff", "manifest", "base-manifest=", "verify="])
     except:
         usage()
     # verify each block after writing if script name contains verify
-    verifyAfterWrite = os.path.basename(sys.argv[0]).find("verify") >= 0
+    if os.path.basename(sys.argv[0]).find("verify") >= 0:
+        verifyAfterWrite = VERIFY_CHECKSUM
+    for o, a in opts:
+        if o == '-D' or o == '--diff':
+            differentialWrite = True
+        elif o == '-M' or o == '--manifest':
+            manifestWrite = True
+        elif o == '-B' or o == '--base-manifest':
+            manifestWrite = True
+            baseManifest = a
+        elif o == '-v' or o == '--verify':
+            if a not in VERIFY_MODES:
+                usage()
+            verifyAfterWrite = a
+    opts = [(o, a) for o, a in opts if o not in ('-D', '--diff', '-M', '--manifest', '-B', '--base-manifest',
+                                                 '-v', '--verify')]
 
     # handle development writing
     if len(opts) > 0:
@@ -144,13 +155,8 @@ def main():
                 savedata = bytearray(b'\xFF' * int(a))
             else:
                 usage()
-        if len(programdata) % PAGESIZE:
-            programdata += b'\xFF' * (PAGESIZE - (len(programdata) % PAGESIZE))
-        if len(savedata) % BLOCKSIZE:
-            savedata += b'\xFF' * (BLOCKSIZE - (len(savedata) % BLOCKSIZE))
-        savepage = (MAX_PAGES - (len(savedata) // PAGESIZE))
-        programpage = savepage - (len(programdata) // PAGESIZE)
-        write_flash(programpage, programdata + savedata)
+        programpage, savepage, flashdata = development_layout(programdata, savedata)
+        write_image(write_flashcart, programpage, flashdata)
         print("\nPlease use the following line in your program setup function:\n")
         if savepage < MAX_PAGES:
             print(f"  Cart::begin(0x{programpage:04X}, 0x{savepage:04X});\n")
@@ -182,25 +188,38 @@ def main():
             print(f"File not found. [{filename}]")
             delayed_exit()
 
-        print(f'Reading flash image from file "{filename}"')
-        f = open(filename, "rb")
-        flashdata = bytearray(f.read())
-        f.close()
-        if len(flashdata) % PAGESIZE != 0:
-            flashdata += b'\xFF' * (PAGESIZE - (len(flashdata) % PAGESIZE))
-
         # Apply patch for SSD1309 displays if script name contains 1309
-        if os.path.basename(sys.argv[0]).find("1309") >= 0:
+        patch = os.path.basename(sys.argv[0]).find("1309") >= 0
+
+        # index files are built and written in one go without an image file
+        if filename.lower().endswith(".csv"):
+            print(f'Building flash image from index file "{filename}"')
+            try:
+                chunks = build_stream(filename)
+            except ArduboyError as e:
+                print(f"Error: {e}")
+                delayed_exit()
+            if patch:
+                print("Patching image for SSD1309 displays...\n")
+                # the boot program of a sketch is always within its program chunk
+                chunks = patched_blocks(chunks)
+            write_image(write_flashcart_stream, pagenumber, chunks)
+            return
+
+        # sparse images are decompressed block by block while writing
+        if is_sparse_image(filename):
+            print(f'Reading sparse flash image from file "{filename}"')
+            if patch:
+                print("Patching image for SSD1309 displays...\n")
+            with open(filename, "rb") as f:
+                write_image(write_sparse_image, pagenumber, f, patch=patch)
+            return
+
+        # the image is memory mapped and written block by block
+        print(f'Reading flash image from file "{filename}"')
+        if patch:
             print("Patching image for SSD1309 displays...\n")
-            lcd_boot_program_addr = 0
-            while lcd_boot_program_addr >= 0:
-                lcd_boot_program_addr = flashdata.find(lcdBootProgram, lcd_boot_program_addr)
-                if lcd_boot_program_addr >= 0:
-                    flashdata[lcd_boot_program_addr + 2] = 0xE3
-                    flashdata[lcd_boot_program_addr + 3] = 0xE3
-        write_flash(pagenumber, flashdata)
-
-    delayed_exit()
+        write_image(write_flashcart_file, pagenumber, filename, patch=patch)
 
 
 if __name__ == '__main__':
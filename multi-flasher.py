@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from getopt import getopt
+
+from arduboy.common import delayed_exit, BootLoader, FlashCartError, compatible_vidpids
+from arduboy.device import open_flashcart
+from arduboy.discovery import find_devices
+from arduboy.errors import ArduboyError
+from arduboy.flashcart import pad_image, write_flashcart
+from arduboy.hexfile import HexFileError
+from arduboy.sketch import check_bootloader_overwrite, load_sketch, verify_sketch, write_sketch
+from arduboy.verify import VERIFY_CHECKSUM, VERIFY_MODES, VERIFY_NONE, VERIFY_SAMPLE
+
+# requires pyserial to be installed. Use "python -m pip install pyserial" on commandline
+
+def log(port, message):
+    print(f"{port:12} {message}")
+
+
+################################################################################
+# images are loaded once and shared read-only by all devices
+
+def load_flashcart(filename):
+    with open(filename, "rb") as f:
+        return bytes(pad_image(bytearray(f.read())))
+
+
+################################################################################
+
+def upload_sketch(bootloader, sketch, verify, timings):
+    # returns the verify mode used
+    check_bootloader_overwrite(bootloader, sketch.page_used)
+    starttime = time.time()
+    write_sketch(bootloader, sketch.flash_data, sketch.page_used)
+    timings["write"] = time.time() - starttime
+    if verify == VERIFY_NONE:
+        return verify
+    starttime = time.time()
+    mode = verify_sketch(bootloader, sketch.flash_data, sketch.page_used, verify=verify)
+    timings["verify"] = time.time() - starttime
+    return mode
+
+
+def write_image(bootloader, flashdata, verify, timings):
+    # returns the verify mode used. Blocks are verified right after writing them, so the
+    # write time includes verifying.
+    cart = open_flashcart(bootloader)
+    if len(flashdata) > cart.capacity:
+        raise FlashCartError(f"Image does not fit in {cart.capacity // 1024} Kbyte flash cart")
+    starttime = time.time()
+    result = write_flashcart(bootloader, cart, 0, flashdata, verify=verify)
+    timings["write"] = time.time() - starttime
+    return result.verify
+
+
+def flash_device(port, task, image, verify):
+    # runs in a thread of its own. Each BootLoader runs its commands on its own event loop.
+    result = {}
+    timings = {}
+    starttime = time.time()
+    bootloader = BootLoader(port, verbose=False)
+    try:
+        bootloader.connect()
+        timings["connect"] = time.time() - starttime
+        log(port, f"bootloader at {bootloader.port}")
+        mode = task(bootloader, image, verify, timings)
+        result["status"] = "OK"
+        if verify == VERIFY_CHECKSUM and mode == VERIFY_SAMPLE:
+            result["note"] = "(no checksum support, verified a sample of pages)"
+    except (ArduboyError, OSError) as e:
+        result["status"] = "FAILED"
+        result["error"] = str(e)
+    except Exception as e:
+        # any other error, like a garbled reply, only fails this device
+        result["status"] = "FAILED"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        try:
+            bootloader.exit()
+        except Exception as e:
+            if result.get("status") == "OK":
+                result["status"] = "FAILED"
+                result["error"] = f"Leaving the bootloader failed: {e}"
+    timings["total"] = time.time() - starttime
+    result["timings"] = timings
+    log(port, f"{result['status']} in {timings['total']:.2f} seconds {result.get('error', result.get('note', ''))}")
+    return result
+
+
+def flash_devices(ports, task, image, verify):
+    with ThreadPoolExecutor(len(ports)) as executor:
+        results = list(executor.map(lambda port: flash_device(port, task, image, verify), ports))
+    return dict(zip(ports, results))
+
+
+################################################################################
+
+def usage():
+    print(f"\nUSAGE:\n\n{os.path.basename(sys.argv[0])} [-v verify] sketch.hex|sketch.arduboy")
+    print(f"{os.path.basename(sys.argv[0])} [-v verify] -f flashcart-image.bin")
+    print()
+    print("Uploads a sketch or writes a flash cart image to all connected Arduboys at once.")
+    print()
+    print("-f --flashcart  Write a flash cart image instead of uploading a sketch.")
+    print("-v --verify     Verify the sketch or each flash cart block after writing: none, checksum")
+    print("                (compare checksums computed by the bootloader, a sample of pages is read")
+    print("                back when the bootloader has no checksum support), sample or full (read")
+    print("                back all data). Default: checksum for sketches, none for flash carts.")
+    print("-n --no-verify  Same as --verify none.")
+    print("-p --port       Only use the given port. May be used more than once.")
+    delayed_exit()
+
+
+def main():
+    try:
+        opts, args = getopt(sys.argv[1:], "hfnv:p:", ["flashcart", "no-verify", "verify=", "port="])
+    except:
+        usage()
+    if len(args) != 1:
+        usage()
+    flashcart = False
+    verify = None
+    ports = []
+    for o, a in opts:
+        if o in ('-f', '--flashcart'):
+            flashcart = True
+        elif o in ('-n', '--no-verify'):
+            verify = VERIFY_NONE
+        elif o in ('-v', '--verify') and a in VERIFY_MODES:
+            verify = a
+        elif o in ('-p', '--port'):
+            ports.append(a)
+        else:
+            usage()
+    filename = args[0]
+    if not os.path.isfile(filename):
+        print(f"File not found. [{filename}]")
+        delayed_exit()
+
+    if flashcart:
+        image = load_flashcart(filename)
+        task = write_image
+        verify = verify or VERIFY_NONE
+        print(f'Loaded flash image "{filename}" ({len(image) // 1024} Kbyte)')
+    else:
+        try:
+            image = load_sketch(filename)
+        except (HexFileError, UnicodeDecodeError, zipfile.BadZipFile):
+            print("Hex file contains errors. upload aborted.")
+            delayed_exit()
+        task = upload_sketch
+        verify = verify or VERIFY_CHECKSUM
+        print(f'Loaded sketch "{filename}" ({sum(image.page_used)} flash pages)')
+
+    if not ports:
+        ports = [device.port for device in find_devices(compatible_vidpids)]
+    if not ports:
+        print("No Arduboys found.")
+        delayed_exit()
+    print(f"Flashing {len(ports)} device(s)\n")
+
+    starttime = time.time()
+    results = flash_devices(ports, task, image, verify)
+
+    print("\nPort         Status  Connect    Write   Verify    Total")
+    print("------------ ------ -------- -------- -------- --------")
+    for port in ports:
+        timings = results[port]["timings"]
+        columns = "".join(f" {timings[phase]:8.2f}" if phase in timings else "        -"
+                          for phase in ("connect", "write", "verify", "total"))
+        print(f"{port:12} {results[port]['status']:6}{columns}")
+    failed = sum(1 for result in results.values() if result["status"] != "OK")
+    print(f"\n{len(ports) - failed} of {len(ports)} devices succeeded in {round(time.time() - starttime, 2)} seconds")
+    if failed:
+        delayed_exit()
+
+
+if __name__ == '__main__':
+    print("\nArduboy multi device flasher\n")
+    main()
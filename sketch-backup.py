@@ -1,6 +1,7 @@
 import time
 
-from common import delayed_exit, BootLoader
+from arduboy.common import BootLoader
+from arduboy.sketch import backup_sketch
 
 
 def main():
@@ -8,17 +9,13 @@ def main():
     bootloader.start()
     filename = time.strftime("sketch-backup-%Y%m%d-%H%M%S.bin", time.localtime())
     print("Reading sketch...")
-    bootloader.write(b"A\x00\x00")
-    bootloader.read(1)
-    bootloader.write(b"g\x70\x00F")
-    backupdata = bytearray(bootloader.read(0x7000))
+    backupdata = backup_sketch(bootloader)
     print(f'saving sketch to "{filename}"')
     f = open(filename, "wb")
     f.write(backupdata)
     f.close()
     print("Done")
     bootloader.exit()
-    delayed_exit()
 
 
 if __name__ == '__main__':